@@ -0,0 +1,59 @@
+"""Compare the selective page parser with the full BeautifulSoup parse it replaced.
+
+Run from the repository root: python bench/bench_parse.py [ROUNDS]
+
+Pages saved as bench/fixtures/*.html are measured as they are; two
+synthetic pages (a DuckDuckGo result page and a heavy article) are always
+included so the benchmark runs without any saved pages.
+"""
+import os
+import sys
+import time
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pageparse
+from pages import fixture_pages
+
+ROUNDS = 5
+
+
+def soup_results(text):
+    soup = BeautifulSoup(text, 'html.parser')
+    return [(a.get_text(), a['href']) for a in soup.find_all('a', class_='result__a')]
+
+
+def soup_details(text):
+    soup = BeautifulSoup(text, 'html.parser')
+    title = soup.title.string if soup.title else soup.get_text().strip().split('\n')[0]
+    description = soup.find('meta', attrs={'name': 'description'})
+    description = description['content'] if description else None
+    return title, description, [img['src'] for img in soup.find_all('img', src=True)]
+
+
+def best_of(rounds, function, *args, **kwargs):
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else ROUNDS
+    pages = fixture_pages()
+
+    print(f"{'PAGE':<24} {'KB':>6} {'BACKEND':<12} {'ms':>8} {'SPEEDUP':>8}")
+    for label, kind, text in pages:
+        baseline, expected = best_of(rounds, soup_results if kind == 'results' else soup_details, text)
+        print(f"{label:<24} {len(text) // 1024:>6} {'bs4 (old)':<12} {baseline * 1000:>8.1f} {'1.0x':>8}")
+        for backend in pageparse.BACKENDS:
+            parse = pageparse.parse_results if kind == 'results' else pageparse.parse_details
+            seconds, result = best_of(rounds, parse, text, backend=backend)
+            same = "" if result == expected else "  (differs)"
+            print(f"{'':<24} {'':>6} {backend:<12} {seconds * 1000:>8.1f} {baseline / seconds:>7.1f}x{same}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""Offline benchmarks of the memory store, the Lua runner and the browser's page loading.
+
+Run from the repository root: python bench/bench_suite.py [--full] [--out FILE]
+
+Everything runs in a temporary directory: archives are built there and
+the browser fetches its pages from a stub HTTP server on localhost. The
+results are printed and written as JSON (bench/results/<date>.json by
+default) so runs can be compared over time.
+
+The store is driven through MemoryStore: store_file_in_zip,
+remove_file_from_local and read_file_from_local are thin wrappers around
+its write_file, remove and iter_lines, and filemanager itself only
+imports on Windows (it needs winreg).
+
+By default archives hold 1k and 10k members and files are 1 KB to 64 MB;
+--full adds 100k members and a 1 GB file, which takes a few GB of disk
+and several minutes.
+"""
+import contextlib
+import functools
+import http.server
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metrics
+from luaengine import LuaEngine
+from memorystore import MemoryStore
+from pages import fixture_pages
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+MEMBERS = (1000, 10000)
+FULL_MEMBERS = (100000,)
+SIZES = (1024, 1024 * 1024, 64 * 1024 * 1024)
+FULL_SIZES = (1024 * 1024 * 1024,)
+ROUNDS = 5
+
+WORDS = "local function return print memory read write table string end for do if then else".split()
+
+LUA_SCRIPT = """
+local words = {}
+for i = 1, 2000 do
+    words[#words + 1] = string.format("%d:%s", i, string.rep("x", i % 17))
+end
+local total = 0
+for _, word in ipairs(words) do
+    total = total + #word
+end
+return total
+"""
+
+
+def text_block(size, rng):
+    """size bytes of text, compressible about as well as scripts and saved pages."""
+    line = ' '.join(rng.choice(WORDS) for _ in range(12)) + '\n'
+    return (line * (size // len(line) + 1)).encode()[:size]
+
+
+def write_text_file(path, size, rng):
+    block = text_block(64 * 1024, rng)
+    with open(path, 'wb') as f:
+        for _ in range(size // len(block)):
+            f.write(block)
+        f.write(block[:size % len(block)])
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+class Results:
+    def __init__(self):
+        self.rows = []
+
+    def add(self, group, name, seconds, rounds=1, per=None, **params):
+        """Record seconds per operation; per names what a rate is counted in (e.g. 'bytes')."""
+        row = {'group': group, 'name': name, 'seconds': seconds, 'rounds': rounds, **params}
+        if per:
+            row[f'{per}_per_second'] = params[per] / seconds if seconds else None
+        self.rows.append(row)
+        details = ' '.join(f"{key}={value:,}" if isinstance(value, int) else f"{key}={value}"
+                           for key, value in params.items())
+        rate = f"  {row[f'{per}_per_second'] / 1e6:.1f} M{per}/s" if per and seconds else ""
+        print(f"{group:<8} {name:<28} {seconds * 1000:>11.3f} ms{rate}  {details}")
+
+
+def bench_members(results, counts, rng, root):
+    for count in counts:
+        memory = MemoryStore(os.path.join(root, f"members-{count}.zip"), compact_threshold=float('inf'))
+        data = text_block(1024, rng)
+        start = time.perf_counter()
+        with memory.transaction() as tx:
+            for i in range(count):
+                tx.write(f"file{i}.txt", data)
+        results.add('memory', 'populate', time.perf_counter() - start, members=count)
+        source = os.path.join(root, "add.txt")
+        write_text_file(source, 1024, rng)
+        adds = [timed(memory.write_file, source, f"added{i}.txt") for i in range(ROUNDS)]
+        results.add('memory', 'store_file_in_zip', min(adds), ROUNDS, members=count, size=1024)
+        reads = [timed(lambda name: sum(1 for _ in memory.iter_lines(name)), f"file{rng.randrange(count)}.txt")
+                 for _ in range(ROUNDS * 10)]
+        results.add('memory', 'read_file_from_local', min(reads), ROUNDS * 10, members=count, size=1024)
+        removes = [timed(memory.remove, f"added{i}.txt") for i in range(ROUNDS)]
+        results.add('memory', 'remove_file_from_local', min(removes), ROUNDS, members=count)
+        results.add('memory', 'compact', timed(memory.compact), members=count)
+        os.remove(memory.path)
+
+
+def bench_sizes(results, sizes, rng, root):
+    for size in sizes:
+        memory = MemoryStore(os.path.join(root, f"size-{size}.zip"), compact_threshold=float('inf'))
+        source = os.path.join(root, "big.txt")
+        write_text_file(source, size, rng)
+        rounds = ROUNDS if size <= 1024 * 1024 else 1
+        adds = [timed(memory.write_file, source, "big.txt") for _ in range(rounds)]
+        results.add('memory', 'store_file_in_zip', min(adds), rounds, per='bytes', bytes=size)
+        reads = [timed(lambda: sum(len(chunk) for chunk in memory.iter_chunks("big.txt"))) for _ in range(rounds)]
+        results.add('memory', 'read_file_from_local', min(reads), rounds, per='bytes', bytes=size)
+        results.add('memory', 'remove_file_from_local', timed(memory.remove, "big.txt"), bytes=size)
+        results.add('memory', 'compact', timed(memory.compact), bytes=size)
+        os.remove(memory.path)
+        os.remove(source)
+
+
+def bench_lua(results, root):
+    memory = MemoryStore(os.path.join(root, "lua.zip"))
+    memory.write("bench.lua", LUA_SCRIPT)
+    # Cold: a new engine has no runtime in its pool and no compiled chunk
+    cold = [timed(lambda: LuaEngine().run("bench.lua", memory.read("bench.lua"), memory)) for _ in range(ROUNDS)]
+    results.add('lua', 'run_lua_program cold', min(cold), ROUNDS)
+    engine = LuaEngine()
+    engine.run("bench.lua", memory.read("bench.lua"), memory)
+    warm = [timed(lambda: engine.run("bench.lua", memory.read("bench.lua"), memory)) for _ in range(ROUNDS * 10)]
+    results.add('lua', 'run_lua_program warm', min(warm), ROUNDS * 10)
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def stub_server(directory):
+    """Serve directory on a free localhost port; yields the base URL."""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             functools.partial(_QuietHandler, directory=directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_browser(results, root):
+    import browse
+    from httpcache import SESSION
+    site = os.path.join(root, "site")
+    os.makedirs(site, exist_ok=True)
+    pages = []
+    for i, (label, kind, text) in enumerate(fixture_pages()):
+        if kind == 'details':
+            with open(os.path.join(site, f"page{i}.html"), 'w', encoding='utf-8') as f:
+                f.write(text)
+            pages.append((label, f"page{i}.html", len(text.encode())))
+    for label, path, size in pages:
+        # fetch_site_details prints what it fetches; that isn't part of the result
+        with stub_server(site) as base, contextlib.redirect_stdout(io.StringIO()):
+            url = f"{base}/{path}"
+            uncached = []
+            for _ in range(ROUNDS):
+                SESSION.cache.clear()
+                uncached.append(timed(browse.fetch_site_details, url))
+            cached = [timed(browse.fetch_site_details, url) for _ in range(ROUNDS)]
+        results.add('browser', 'fetch_site_details', min(uncached), ROUNDS, page=label, bytes=size)
+        results.add('browser', 'fetch_site_details cached', min(cached), ROUNDS, page=label, bytes=size)
+
+
+def main(argv):
+    full = '--full' in argv
+    out = argv[argv.index('--out') + 1] if '--out' in argv[:-1] else os.path.join(
+        RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    out = os.path.abspath(out)
+    rng = random.Random(1)
+    results = Results()
+    root = tempfile.mkdtemp(prefix="sussy-bench-")
+    cwd = os.getcwd()
+    os.chdir(root)  # The HTTP cache and anything else relative lands in the temp dir
+    try:
+        bench_members(results, MEMBERS + (FULL_MEMBERS if full else ()), rng, root)
+        bench_sizes(results, SIZES + (FULL_SIZES if full else ()), rng, root)
+        bench_lua(results, root)
+        bench_browser(results, root)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump({'when': time.strftime("%Y-%m-%dT%H:%M:%S"), 'python': platform.python_version(),
+                   'platform': platform.platform(), 'full': full, 'results': results.rows,
+                   'metrics': metrics.snapshot()}, f, indent=1)
+    print(f"Results written to {out}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,42 @@
+"""Test pages shared by the benchmarks: two synthetic ones and any saved in bench/fixtures."""
+import glob
+import os
+import random
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def synthetic_results(count=30, rng=random.Random(1)):
+    results = ''.join(
+        f'<div class="result results_links web-result"><div class="links_main">'
+        f'<h2 class="result__title"><a rel="nofollow" class="result__a" '
+        f'href="//duckduckgo.com/l/?uddg=https%3A%2F%2Fexample{i}.com%2F&amp;rut=x">Result <b>{i}</b> title</a></h2>'
+        f'<a class="result__snippet" href="#">{" ".join(rng.choice(["lorem", "ipsum", "dolor"]) for _ in range(40))}</a>'
+        f'</div></div>'
+        for i in range(count))
+    footer = '<div class="nav-link">' + '<span>more</span>' * 2000 + '</div>'
+    return (f'<html><head><title>q at DuckDuckGo</title><style>{"a{color:red}" * 500}</style></head>'
+            f'<body><div id="links" class="results">{results}</div>{footer}</body></html>')
+
+
+def synthetic_article(paragraphs=3000, images=60, rng=random.Random(2)):
+    script = '<script>' + 'var x = "<a href=1>";' * 5000 + '</script>'
+    body = []
+    for i in range(paragraphs):
+        body.append(f'<p class="c{i % 7}"><span>{" ".join(rng.choice(["alpha", "beta", "gamma"]) for _ in range(30))}'
+                    f'</span> <a href="/p/{i}">link</a></p>')
+        if i % (paragraphs // images) == 0:
+            body.append(f'<figure><img src="/img/{i}.jpg" alt="pic"><figcaption>pic {i}</figcaption></figure>')
+    return (f'<html><head><title>Heavy article</title><meta name="description" content="A long page">'
+            f'{script}</head><body>{"".join(body)}</body></html>')
+
+
+def fixture_pages():
+    """(label, 'results' or 'details', html) for the synthetic pages and every bench/fixtures/*.html."""
+    pages = [("synthetic results", 'results', synthetic_results()),
+             ("synthetic article", 'details', synthetic_article())]
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, "*.html"))):
+        with open(path, encoding='utf-8', errors='replace') as f:
+            text = f.read()
+        pages.append((os.path.basename(path), 'results' if 'result__a' in text else 'details', text))
+    return pages
@@ -1,16 +1,20 @@
-import os
+import concurrent.futures
+import time
 import requests
-from bs4 import BeautifulSoup
-from zipfile import ZipFile
-from urllib.parse import urlparse, parse_qs, urljoin
-
-# Path to memory zip
-memory_zip_path = "memory.zip"
-
-# Ensure memory.zip exists
-if not os.path.exists(memory_zip_path):
-    with ZipFile(memory_zip_path, 'w') as zipf:
-        pass
+import downloader
+import metrics
+import pageparse
+from urllib.parse import urlparse, parse_qs
+from commands import CommandError, command, help_command, stats_command
+from httpcache import SESSION
+from memorystore import MemoryStore
+from searchcache import SEARCH_CACHE
+
+# While the result list is on screen, details of the top PREFETCH_TOP
+# results are fetched in the background
+PREFETCH_TOP = 3
+_prefetch_pool = concurrent.futures.ThreadPoolExecutor(PREFETCH_TOP)
+_prefetched = {}  # url -> Future of load_site_details(url)
 
 def extract_actual_url(duckduckgo_url):
     parsed_url = urlparse(duckduckgo_url)
@@ -26,47 +30,61 @@ def extract_actual_url(duckduckgo_url):
 
 def search_engine(query):
     print(f"Searching for '{query}' on DuckDuckGo...")
-    response = requests.get(f"https://duckduckgo.com/html/?q={query}")
+    cached = SEARCH_CACHE.get(query)
+    if cached is not None:
+        print("(results from a recent search)")
+        return cached
+    response = SESSION.get("https://duckduckgo.com/html/", params={'q': query})
     if response.status_code != 200:
         print("Failed to connect to DuckDuckGo.")
         return []
 
-    soup = BeautifulSoup(response.text, 'html.parser')
     results = []
-    for result in soup.find_all('a', class_='result__a'):
-        title = result.get_text()
-        link = result['href']
+    # Only the result links are picked out of the page, no tree is built
+    for title, link in pageparse.parse_results(response.text):
         if link.startswith('//'):
             link = 'https:' + link
         link = extract_actual_url(link)
         results.append((title, link))
+    if results:
+        SEARCH_CACHE.put(query, results)
     return results
 
+def load_site_details(url):
+    """(title, description, image urls, base url) of a page; raises on errors, prints nothing."""
+    # The shared session sends the browser User-Agent and reuses connections;
+    # a page seen before comes from the cache or costs a 304
+    response = SESSION.get(url)
+    response.raise_for_status()
+    title, description, srcs = pageparse.parse_details(response.text)
+    description = description if description is not None else "No Description"
+
+    base_url = f"{urlparse(url).scheme}://{urlparse(url).netloc}"
+    files = []
+    # Find all image URLs in the page
+    for img_url in srcs:
+        # Ensure it is a full URL
+        if img_url.startswith('/'):
+            img_url = base_url + img_url
+        files.append(img_url)
+
+    return title, description, files, base_url
+
+def prefetch_site_details(results):
+    """Start loading the top results' details in the background, dropping older prefetches."""
+    for future in _prefetched.values():
+        future.cancel()
+    _prefetched.clear()
+    for _, link in results[:PREFETCH_TOP]:
+        _prefetched[link] = _prefetch_pool.submit(load_site_details, link)
+
 def fetch_site_details(url):
     print(f"Fetching details for {url}...")
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-        }
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        title = soup.title.string if soup.title else soup.get_text().strip().split('\n')[0]
-        description = soup.find('meta', attrs={'name': 'description'})
-        description = description['content'] if description else "No Description"
-
-        base_url = f"{urlparse(url).scheme}://{urlparse(url).netloc}"
-        files = []
-        # Find all image URLs in the page
-        for img_tag in soup.find_all('img', src=True):
-            img_url = img_tag['src']
-            # Ensure it is a full URL
-            if img_url.startswith('/'):
-                img_url = base_url + img_url
-            files.append(img_url)
-
-        return title, description, files, base_url
+        future = _prefetched.pop(url, None)
+        if future is not None and not future.cancelled():
+            return future.result()
+        return load_site_details(url)
     except requests.exceptions.RequestException as e:
         print(f"Error fetching site: {e}")
         return "Error", "Error", [], ""
@@ -75,50 +93,86 @@ def fetch_site_details(url):
         return "Error", "Error", [], ""
 
 
-def download_file(url, filename, base_url):
-    print(f"Downloading {filename}...")
-
-    try:
-        # If the URL starts with double slashes (//), prepend with https
-        if url.startswith('//'):
-            url = 'https:' + url
-
-        # If the URL is relative, join it with the base URL
-        elif not url.startswith('http'):
-            url = urljoin(base_url, url)
-
-        # Send the request and follow redirects
-        response = requests.get(url, stream=True, allow_redirects=True)
-
-        # Check if the response is an image
-        if 'image' not in response.headers['Content-Type']:
-            print(f"Skipping {filename} (not an image).")
-            return
-
-        # Download the image
-        if response.status_code == 200:
-            with open(filename, 'wb') as file:
-                for chunk in response.iter_content(1024):
-                    file.write(chunk)
-
-            print(f"File {filename} downloaded successfully.")
-
-            # Add the file to memory.zip
-            with ZipFile(memory_zip_path, 'a') as zipf:
-                zipf.write(filename, os.path.basename(filename))  # Ensure only the filename is saved
-            print(f"File {filename} added to memory.zip.")
-
-            # Optionally remove the local file after adding it to the zip
-            os.remove(filename)
-            print(f"File {filename} removed from local disk after zipping.")
-        else:
-            print(f"Failed to download the file: {url}")
-    except Exception as e:
-        print(f"Error downloading file: {e}")
+def show_progress(done, total, fresh, seconds):
+    speed = fresh / seconds / 1024 / 1024 if seconds else 0
+    if total:
+        print(f"\r{done / 1024 / 1024:.1f} of {total / 1024 / 1024:.1f} MB ({done * 100 // total}%), "
+              f"{speed:.1f} MB/s   ", end='', flush=True)
+    else:
+        print(f"\r{done / 1024 / 1024:.1f} MB, {speed:.1f} MB/s   ", end='', flush=True)
 
 
+def download_file(memory, url, filename, base_url):
+    print(f"Downloading {filename}...")
+    # Resumable: a failed download continues from its .part file next time
+    result = downloader.download_resumable(memory, downloader.resolve_url(url, base_url), filename,
+                                           progress=show_progress)
+    print()
+    if result.ok:
+        print(f"File {filename} added to memory.zip ({result.size} bytes, "
+              f"{result.size / 1024 / 1024 / result.seconds:.1f} MB/s).")
+    elif result.error == "not an image":
+        print(f"Skipping {filename} (not an image).")
+    else:
+        print(f"Error downloading file: {result.error}")
+        if result.size:
+            print(f"{result.size} bytes are kept, downloading it again will resume.")
+
+
+def download_all_files(memory, files, base_url):
+    files = downloader.name_files(files, base_url)
+    print(f"Downloading {len(files)} files...")
+    start = time.perf_counter()
+    results = downloader.download_all(memory, files)
+    for result in results:
+        status = f"{result.size} bytes" if result.ok else f"failed: {result.error}"
+        print(f"{result.name} - {status} ({result.seconds:.2f}s)")
+    done = [result for result in results if result.ok]
+    print(f"{len(done)} of {len(results)} files added to memory.zip "
+          f"({sum(result.size for result in done)} bytes in {time.perf_counter() - start:.2f}s).")
+
+
+
+# Non-interactive commands, for sussy.run("browser ...") and batch files
+
+help_command("browser")
+stats_command("browser")
+
+@command("browser", "search", "QUERY")
+def search_command(memory, args):
+    results = search_engine(args)
+    for i, (title, link) in enumerate(results):
+        print(f"{i+1}. {title} - {link}")
+    return results
 
-def main():
+@command("browser", "details", "URL")
+def details_command(memory, args):
+    title, description, files, base_url = load_site_details(args)
+    print(f"Title: {title}")
+    print(f"Description: {description}")
+    return {'title': title, 'description': description, 'files': files, 'base_url': base_url}
+
+@command("browser", "download", "URL [NAME]")
+def download_command(memory, args):
+    url, _, name = args.partition(' ')
+    result = downloader.download_resumable(memory, url, name.strip() or downloader.name_files([url], '')[0][1])
+    if not result.ok:
+        raise CommandError(f"Error downloading file: {result.error}")
+    print(f"File {result.name} added to memory.zip ({result.size} bytes).")
+    return result._asdict()
+
+@command("browser", "download-all", "PAGE_URL")
+def download_all_command(memory, args):
+    _, _, files, base_url = load_site_details(args)
+    results = downloader.download_all(memory, downloader.name_files(files, base_url))
+    for result in results:
+        print(f"{result.name} - {result.size} bytes" if result.ok else f"{result.name} - failed: {result.error}")
+    return [result._asdict() for result in results]
+
+
+def main(memory=None):
+    if memory is None:
+        memory = MemoryStore()
     while True:
         print("\nSussy Browser")
         print("1. Search")
@@ -127,13 +181,15 @@ def main():
 
         if choice == '1':
             query = input("Enter search query: ")
-            results = search_engine(query)
+            with metrics.timed("browser search"):
+                results = search_engine(query)
             if not results:
                 print("No results found.")
                 continue
 
             for i, (title, link) in enumerate(results):
                 print(f"{i+1}. {title} - {link}")
+            prefetch_site_details(results)
 
             try:
                 selection = int(input("Select a result (number): ")) - 1
@@ -142,7 +198,8 @@ def main():
                     continue
 
                 title, link = results[selection]
-                site_title, site_description, files, base_url = fetch_site_details(link)
+                with metrics.timed("browser details"):
+                    site_title, site_description, files, base_url = fetch_site_details(link)
                 print(f"Title: {site_title}")
                 print(f"Description: {site_description}")
 
@@ -150,16 +207,24 @@ def main():
                     print("Files available for download:")
                     for i, file_url in enumerate(files):
                         print(f"{i+1}. {file_url}")
+                    if len(files) == pageparse.MAX_IMAGES:
+                        print(f"(first {len(files)} images)")
 
                     try:
-                        file_selection = int(input("Select a file to download (number): ")) - 1
+                        file_selection = input("Select a file to download (number, or 'all'): ").strip()
+                        if file_selection.lower() == "all":
+                            with metrics.timed("browser download-all"):
+                                download_all_files(memory, files, base_url)
+                            continue
+                        file_selection = int(file_selection) - 1
                         if file_selection < 0 or file_selection >= len(files):
                             print("Invalid selection.")
                             continue
 
                         file_url = files[file_selection]
                         filename = file_url.split('/')[-1]
-                        download_file(file_url, filename, base_url)
+                        with metrics.timed("browser download"):
+                            download_file(memory, file_url, filename, base_url)
                     except ValueError:
                         print("Invalid input. Please enter a number.")
                 else:
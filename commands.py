@@ -0,0 +1,144 @@
+import collections
+import contextlib
+import importlib
+import io
+import shlex
+import time
+import metrics
+from memorystore import MemoryStore
+
+# App name -> module. A module registers its commands when it is imported,
+# which only happens the first time one of them is used.
+APPS = {"browser": "browse", "filemanager": "filemanager", "programmer": "programmer"}
+
+Command = collections.namedtuple('Command', 'app name handler usage')
+CommandResult = collections.namedtuple('CommandResult', 'command ok value output error seconds')
+
+# app -> {command name -> Command}
+REGISTRY = {}
+
+
+class CommandError(Exception):
+    """A command couldn't do what it was asked: missing file, bad arguments and so on."""
+
+
+def command(app, name, usage=""):
+    """Register handler(memory, args) as 'APP NAME ARGS'.
+
+    The handler gets the MemoryStore and the rest of the line. It must not
+    prompt; it returns a value for the caller (prints are captured as the
+    command's output) and raises CommandError when it fails.
+    """
+    def register(handler):
+        REGISTRY.setdefault(app, {})[name] = Command(app, name, handler, usage)
+        return handler
+    return register
+
+
+def lookup(app, name):
+    if app not in APPS:
+        raise CommandError(f"Unknown app '{app}', apps are: {', '.join(APPS)}")
+    importlib.import_module(APPS[app])
+    commands = REGISTRY.get(app, {})
+    if name not in commands:
+        raise CommandError(f"Unknown command '{app} {name}', use '{app} help'")
+    return commands[name]
+
+
+def run_from_menu(app, name, memory, args):
+    """Run a registered command from an app's interactive menu.
+
+    Its latency is recorded under the same name as when it is dispatched,
+    and a CommandError is printed instead of raised.
+    """
+    cmd = lookup(app, name)
+    with metrics.timed(f"{app} {name}"):
+        try:
+            return cmd.handler(memory, args)
+        except CommandError as e:
+            metrics.count('commands failed')
+            print(f"{e}!")
+
+
+def parse_args(args, usage, *converters):
+    """Split a command's args shell-style ("quoted names" keep their spaces), one part per converter.
+
+    Each part goes through its converter (str keeps it as it is). Raises
+    CommandError showing usage when there are more or fewer parts than
+    converters, or a part doesn't convert.
+    """
+    try:
+        parts = shlex.split(args)
+    except ValueError:  # An unclosed quote
+        parts = None
+    if parts is None or len(parts) != len(converters):
+        raise CommandError(f"Usage: {usage}")
+    try:
+        return [convert(part) for convert, part in zip(converters, parts)]
+    except ValueError:
+        raise CommandError(f"Usage: {usage}")
+
+
+def usage(app):
+    """'APP NAME USAGE' lines for every command of app."""
+    lookup(app, 'help')
+    return [f"{app} {cmd.name} {cmd.usage}".rstrip() for cmd in REGISTRY[app].values()]
+
+
+class Dispatcher:
+    """Runs 'APP COMMAND ARGS' lines without any prompts.
+
+    The memory store and whatever the apps keep open (its cached index, the
+    pooled HTTP session, warm Lua runtimes) stay alive from one command to
+    the next, so a long batch doesn't pay start-up costs per command.
+    """
+
+    def __init__(self, memory=None):
+        self.memory = memory if memory is not None else MemoryStore()
+
+    def run(self, line):
+        """Run one command line. Returns a CommandResult, never raises for a failed command."""
+        start = time.perf_counter()
+        app, _, rest = line.strip().partition(' ')
+        name, _, args = rest.strip().partition(' ')
+        output = io.StringIO()
+        cmd = None
+        try:
+            cmd = lookup(app.lower(), name.lower())
+            with contextlib.redirect_stdout(output):
+                value = cmd.handler(self.memory, args.strip())
+            ok, error = True, None
+        except Exception as e:
+            value, ok, error = None, False, str(e) or type(e).__name__
+            metrics.count('commands failed')
+        seconds = time.perf_counter() - start
+        if cmd is not None:
+            metrics.observe(f"{cmd.app} {cmd.name}", seconds)
+        return CommandResult(line.strip(), ok, value, output.getvalue(), error, seconds)
+
+    def run_many(self, lines):
+        """Yield a result for every command in lines, skipping blank lines and # comments."""
+        for line in lines:
+            if line.strip() and not line.lstrip().startswith('#'):
+                yield self.run(line)
+
+
+def help_command(app):
+    """Register 'APP help', listing the app's commands."""
+    @command(app, "help")
+    def show_help(memory, args):
+        lines = usage(app)
+        for line in lines:
+            print(line)
+        return lines
+    return show_help
+
+
+def stats_command(app):
+    """Register 'APP stats', printing the process-wide metrics (see metrics.py)."""
+    @command(app, "stats")
+    def show_stats(memory, args):
+        for line in metrics.report():
+            print(line)
+        return metrics.snapshot()
+    return show_stats
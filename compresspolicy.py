@@ -0,0 +1,84 @@
+import os
+import zipfile
+import zlib
+
+# Codec names accepted by MemoryStore(compression=...) and 'add ... --compress NAME'
+CODECS = {
+    'stored': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+}
+CODEC_NAMES = {value: key for key, value in CODECS.items()}
+POLICIES = ('auto',) + tuple(CODECS)
+
+# Formats that are compressed already, compressing them again only costs CPU
+STORED_EXTENSIONS = {
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'avif', 'heic', 'ico',
+    'zip', 'gz', 'tgz', 'bz2', 'xz', 'lzma', '7z', 'rar', 'zst', 'jar', 'apk',
+    'docx', 'xlsx', 'pptx', 'odt', 'epub', 'pdf',
+    'mp3', 'mp4', 'm4a', 'aac', 'ogg', 'opus', 'flac', 'mkv', 'webm', 'avi', 'mov',
+    'woff', 'woff2',
+}
+MAGIC_NUMBERS = (
+    b'\xff\xd8\xff',        # jpeg
+    b'\x89PNG',             # png
+    b'GIF8',                # gif
+    b'PK\x03\x04',          # zip and everything built on it
+    b'\x1f\x8b',            # gzip
+    b'BZh',                 # bzip2
+    b'\xfd7zXZ',            # xz
+    b'7z\xbc\xaf',          # 7z
+    b'Rar!',                # rar
+    b'\x28\xb5\x2f\xfd',    # zstd
+    b'ID3',                 # mp3
+    b'OggS',                # ogg
+    b'fLaC',                # flac
+    b'\x1aE\xdf\xa3',       # mkv / webm
+    b'wOF2', b'wOFF',       # web fonts
+)
+TEXT_EXTENSIONS = {
+    'txt', 'lua', 'py', 'md', 'html', 'htm', 'css', 'js', 'json', 'xml', 'svg',
+    'csv', 'tsv', 'log', 'ini', 'cfg', 'conf', 'yaml', 'yml', 'toml', 'sql',
+}
+# Tabular text, where bzip2's block sorting wins
+BZIP2_EXTENSIONS = {'csv', 'tsv', 'log'}
+
+SAMPLE_SIZE = 64 * 1024
+# Below this a member is stored: headers would eat the savings
+TINY_SIZE = 64
+# Sample ratio (compressed / original) above which compressing isn't worth it
+INCOMPRESSIBLE_RATIO = 0.9
+# Tabular text this large gets bzip2 instead of deflate: about half the size
+# for under three times the time. lzma is only used when asked for; on text
+# it saves about a quarter over deflate but is over ten times slower.
+LARGE_TEXT_SIZE = 1024 * 1024
+DEFLATE_LEVEL = 6
+
+
+def choose(name, sample, size=None, policy='auto'):
+    """Pick (compress_type, compresslevel) for a member.
+
+    sample is the start of the payload and size its full length (defaults
+    to len(sample)). With policy 'auto' the choice goes by extension, then
+    magic bytes, then how well a quick deflate squeezes the sample; any
+    other policy forces that codec.
+    """
+    if policy != 'auto':
+        return CODECS[policy], None
+    size = len(sample) if size is None else size
+    extension = os.path.splitext(name)[1].lower().lstrip('.')
+    if size < TINY_SIZE or extension in STORED_EXTENSIONS or sample.startswith(MAGIC_NUMBERS):
+        return zipfile.ZIP_STORED, None
+    if extension not in TEXT_EXTENSIONS:
+        sample = bytes(sample[:SAMPLE_SIZE])
+        if len(zlib.compress(sample, 1)) > len(sample) * INCOMPRESSIBLE_RATIO:
+            return zipfile.ZIP_STORED, None
+    if size >= LARGE_TEXT_SIZE and extension in BZIP2_EXTENSIONS:
+        return zipfile.ZIP_BZIP2, 9
+    return zipfile.ZIP_DEFLATED, DEFLATE_LEVEL
+
+
+def read_sample(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read(SAMPLE_SIZE)
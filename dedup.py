@@ -0,0 +1,100 @@
+import hashlib
+import random
+
+# Members under this prefix belong to the store itself and are never listed
+RESERVED_PREFIX = ".sussy/"
+BLOB_PREFIX = RESERVED_PREFIX + "blobs/"
+
+# Comment that marks a member as a pointer to blobs: "sussy-dedup SIZE SHA256"
+POINTER_MARK = b"sussy-dedup "
+
+# Content-defined chunking of large payloads. Every byte gets a bit from the
+# WINDOW bytes ending at it (their weights summed, the sum looked up), and a
+# cut is made where the bits of the last CUT_BITS bytes spell out _CUT, so an
+# insertion only changes the chunks around it and the rest still match blobs
+# already stored. Half of _CUT's bits are set, which keeps chunks near their
+# usual size when the data leans on some byte values.
+MIN_CHUNK = 256 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+CUT_BITS = 19  # ~512 KB past MIN_CHUNK on average
+WINDOW = 16  # Sums of 16 weights under 16 still fit in a byte
+SCAN_BLOCK = 256 * 1024  # Looked through for a cut at a time, not to scan up to MAX_CHUNK for each
+
+READ_BUFFER = 1024 * 1024
+
+# Fixed seed: the tables must be the same in every session or nothing would match
+_rng = random.Random(0x5055)
+_WEIGHTS = bytes(_rng.randrange(256 // WINDOW) for _ in range(256))
+_BITS = bytes(_rng.getrandbits(1) for _ in range(256))
+_CUT = bytes(_rng.sample([i % 2 for i in range(CUT_BITS)], CUT_BITS))
+_ONES = int.from_bytes(bytes([1] * WINDOW), 'little')
+
+
+def blob_name(chunk):
+    return BLOB_PREFIX + hashlib.sha256(chunk).hexdigest()
+
+
+def is_pointer(info):
+    return info.comment.startswith(POINTER_MARK)
+
+
+def pointer_comment(size, digest):
+    return POINTER_MARK + f"{size} {digest}".encode()
+
+
+def parse_pointer(info):
+    """(size, sha256) recorded on a pointer member."""
+    size, digest = info.comment[len(POINTER_MARK):].decode().split()
+    return int(size), digest
+
+
+def file_digest(fileobj):
+    """Size and sha256 of everything left in fileobj."""
+    sha = hashlib.sha256()
+    size = 0
+    for block in iter(lambda: fileobj.read(READ_BUFFER), b''):
+        sha.update(block)
+        size += len(block)
+    return size, sha.hexdigest()
+
+
+def _window_bits(data):
+    """The bit of every byte of data that has a whole WINDOW behind it (len(data) - WINDOW + 1 of them).
+
+    Nothing loops over the bytes in Python: bytes.translate gives every
+    byte its weight, and multiplying them as one little-endian int by
+    WINDOW ones adds up each window in one go; no sum carries into the next
+    byte.
+    """
+    sums = (int.from_bytes(data.translate(_WEIGHTS), 'little') * _ONES).to_bytes(len(data) + WINDOW, 'little')
+    return sums[WINDOW - 1:len(data)].translate(_BITS)
+
+
+def _find_cut(buf, pos):
+    """Length of the next chunk, the one starting at buf[pos]."""
+    end = min(len(buf) - pos, MAX_CHUNK)
+    if end <= MIN_CHUNK:
+        return end
+    first = MIN_CHUNK + 1 - CUT_BITS  # The earliest cut comes right after byte MIN_CHUNK
+    while first + CUT_BITS <= end:
+        last = min(first + SCAN_BLOCK, end)
+        found = _window_bits(buf[pos + first - WINDOW + 1:pos + last]).find(_CUT)
+        if found >= 0:
+            return first + found + CUT_BITS
+        first = last - CUT_BITS + 1
+    return end
+
+
+def split(fileobj):
+    """Yield content-defined chunks of fileobj; small payloads come out as one chunk."""
+    buf, pos = b'', 0
+    while True:
+        more = fileobj.read(MAX_CHUNK)
+        buf = buf[pos:] + more
+        pos = 0
+        while len(buf) - pos >= MAX_CHUNK or (pos < len(buf) and not more):
+            cut = _find_cut(buf, pos)
+            yield buf[pos:pos + cut]
+            pos += cut
+        if not more:
+            return
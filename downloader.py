@@ -0,0 +1,402 @@
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+from urllib.parse import urljoin, urlparse, unquote
+import requests
+import dedup
+from httpcache import SESSION
+
+# Downloads running at once, and at most this many against any one host
+WORKERS = 8
+PER_HOST = 4
+# Workers keep bodies up to this size in memory; a bigger one goes to a
+# temporary file until it is stored
+INMEMORY_LIMIT = 16 * 1024 * 1024
+CHUNK_SIZE = 256 * 1024
+
+# Resumable downloads keep their partial bytes (and a .json with their
+# progress) here until they are complete and stored
+PART_DIR = "partial"
+BUFFER_SIZE = 1024 * 1024
+# Files at least SPLIT_MIN long are fetched as PARTS parallel byte ranges
+# when the server accepts ranges
+PARTS = 4
+SPLIT_MIN = 8 * 1024 * 1024
+# Progress is saved after this many bytes of a range, so a crash loses little
+SAVE_EVERY = 4 * 1024 * 1024
+# Broken connections are picked up where they stopped this many times
+RESUME_ATTEMPTS = 3
+RESUME_DELAY = 1
+PROGRESS_EVERY = 0.25
+# Ranges must count raw bytes, not a gzip-decoded body
+_IDENTITY = {'Accept-Encoding': 'identity'}
+
+DownloadResult = collections.namedtuple('DownloadResult', 'url name ok size error seconds')
+
+
+def resolve_url(url, base_url):
+    """Absolute URL for an image src found on a page."""
+    # If the URL starts with double slashes (//), prepend with https
+    if url.startswith('//'):
+        return 'https:' + url
+    # If the URL is relative, join it with the base URL
+    if not url.startswith('http'):
+        return urljoin(base_url, url)
+    return url
+
+
+def name_files(urls, base_url):
+    """(url, member name) pairs for urls, named after the last path part and kept unique."""
+    files = []
+    taken = set()
+    for url in urls:
+        url = resolve_url(url, base_url)
+        name = unquote(os.path.basename(urlparse(url).path)) or "download"
+        stem, ext = os.path.splitext(name)
+        for n in itertools.count(2):
+            if name not in taken:
+                break
+            name = f"{stem} ({n}){ext}"
+        taken.add(name)
+        files.append((url, name))
+    return files
+
+
+def _fetch(session, url, gate):
+    """Download url into a spool, holding the host's gate while reading. Returns (spool, size).
+
+    The spool is a temporary file, kept in memory up to INMEMORY_LIMIT.
+    """
+    with gate, session.stream(url) as response:
+        response.raise_for_status()
+        if 'image' not in response.headers.get('Content-Type', ''):
+            raise ValueError("not an image")
+        spool = tempfile.SpooledTemporaryFile(INMEMORY_LIMIT)
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                spool.write(chunk)
+        except BaseException:
+            spool.close()
+            raise
+    size = spool.tell()
+    spool.seek(0)
+    return spool, size
+
+
+def _store(memory, finished, results):
+    """Commit finished downloads, (url, name, start, spool, size) each, in one transaction."""
+    errors = {}
+    try:
+        with memory.transaction() as tx:
+            for url, name, start, spool, size in finished:
+                try:
+                    tx.write_stream(name, iter(lambda: spool.read(CHUNK_SIZE), b''), size)
+                except Exception as e:
+                    errors[name] = str(e)
+    except Exception as e:
+        # Nothing of this batch was committed
+        errors = {name: errors.get(name, str(e)) for _, name, _, _, _ in finished}
+    finally:
+        for _, _, _, spool, _ in finished:
+            spool.close()
+    for url, name, start, spool, size in finished:
+        error = errors.get(name)
+        results.append(DownloadResult(url, name, error is None, 0 if error else size, error,
+                                      time.perf_counter() - start))
+
+
+def download_all(memory, files, workers=WORKERS, per_host=PER_HOST, session=SESSION):
+    """Download (url, name) pairs concurrently into memory.zip. Returns DownloadResults.
+
+    A bounded thread pool does the fetching, with at most per_host
+    connections to any one server, each into a temporary spool. This
+    thread is the single archive writer: whenever downloads finish it
+    commits the ones that are done in one short transaction, so the
+    archive's write lock is never held while waiting on the network.
+    """
+    gates = collections.defaultdict(lambda: threading.BoundedSemaphore(per_host))
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        started = {}
+        for url, name in files:
+            gate = gates[urlparse(url).netloc]
+            future = pool.submit(_fetch, session, url, gate)
+            started[future] = (url, name, time.perf_counter())
+        order = {name: i for i, (_, name) in enumerate(files)}
+        pending = set(started)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            finished = []
+            for future in done:
+                url, name, start = started[future]
+                try:
+                    finished.append((url, name, start, *future.result()))
+                except Exception as e:
+                    results.append(DownloadResult(url, name, False, 0, str(e), time.perf_counter() - start))
+            if finished:
+                _store(memory, finished, results)
+    return sorted(results, key=lambda result: order[result.name])
+
+
+class _RangeIgnored(Exception):
+    """The server sent the whole file instead of the range asked for."""
+
+
+class PartialDownload:
+    """A resumable download: a .part file plus a .json of which byte ranges are done.
+
+    Each range is [start, pos, end, crc]: bytes start..pos are on disk, end
+    is None when the length isn't known, and crc is the CRC-32 of those
+    bytes as they came off the network. The state names the URL and the
+    validator (ETag or Last-Modified) it was fetched under, so a file that
+    changed on the server starts over instead of being patched together.
+    """
+
+    def __init__(self, url, name, directory=PART_DIR):
+        tag = hashlib.sha256(url.encode()).hexdigest()[:12]
+        self.path = os.path.join(directory, f"{tag}-{name.replace('/', '_')}.part")
+        self.url = url
+        self.length = None
+        self.validator = None
+        self.ranges = []
+        self.fresh = 0  # Bytes fetched in this session, for the speed
+        self._lock = threading.Lock()
+        self._unsaved = 0
+
+    def resume(self, length, validator):
+        """Pick up saved progress if it is for the same version of the file."""
+        try:
+            with open(self.path + '.json', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if (state['url'], state['length'], state['validator']) != (self.url, length, validator) \
+                or not validator or not os.path.exists(self.path) \
+                or any(len(r) != 4 for r in state['ranges']):
+            return False
+        self.length, self.validator, self.ranges = length, validator, state['ranges']
+        return True
+
+    def begin(self, length, validator, parts):
+        """Start from nothing, as parts ranges when the length is known."""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.length, self.validator = length, validator
+        if length is None or parts <= 1:
+            self.ranges = [[0, 0, length, 0]]
+        else:
+            bounds = [length * i // parts for i in range(parts + 1)]
+            self.ranges = [[lo, lo, hi, 0] for lo, hi in zip(bounds, bounds[1:])]
+        with open(self.path, 'wb') as f:
+            if length:
+                f.truncate(length)
+        self.save()
+
+    def save(self):
+        with self._lock:
+            state = {'url': self.url, 'length': self.length, 'validator': self.validator,
+                     'ranges': self.ranges}
+            with open(self.path + '.json.tmp', 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(self.path + '.json.tmp', self.path + '.json')
+            self._unsaved = 0
+
+    def done(self):
+        return sum(pos - start for start, pos, _, _ in self.ranges)
+
+    def _advance(self, index, pos, crc, count):
+        with self._lock:
+            state = self.ranges[index]
+            state[1], state[3] = pos, crc
+            self.fresh += count
+            self._unsaved += count
+            due = self._unsaved >= SAVE_EVERY
+        if due:
+            self.save()
+
+    def _fetch_range(self, session, index, buffer_size):
+        start, pos, end, crc = self.ranges[index]
+        headers = dict(_IDENTITY)
+        if pos or end is not None:
+            headers['Range'] = f"bytes={pos}-{'' if end is None else end - 1}"
+            if self.validator:
+                headers['If-Range'] = self.validator
+        with session.stream(self.url, headers=headers) as response:
+            response.raise_for_status()
+            if 'Range' in headers and response.status_code != 206:
+                if len(self.ranges) > 1 or pos:
+                    raise _RangeIgnored()
+            with open(self.path, 'r+b') as f:
+                f.seek(pos)
+                for chunk in response.iter_content(buffer_size):
+                    if end is not None:
+                        chunk = chunk[:end - pos]
+                    f.write(chunk)
+                    pos += len(chunk)
+                    crc = zlib.crc32(chunk, crc)
+                    self._advance(index, pos, crc, len(chunk))
+                    if end is not None and pos >= end:
+                        break
+        if end is not None and pos < end:
+            raise requests.ConnectionError(f"connection closed {end - pos} bytes early")
+
+    def fetch(self, session, buffer_size=BUFFER_SIZE, progress=None):
+        """Fetch every unfinished range, each on its own connection."""
+        todo = [i for i, (_, pos, end, _) in enumerate(self.ranges) if end is None or pos < end]
+        started = time.perf_counter()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max(len(todo), 1)) as pool:
+                jobs = [pool.submit(self._fetch_range, session, i, buffer_size) for i in todo]
+                while jobs:
+                    finished, _ = concurrent.futures.wait(jobs, PROGRESS_EVERY)
+                    for job in finished:
+                        jobs.remove(job)
+                        job.result()
+                    if progress:
+                        progress(self.done(), self.length, self.fresh, time.perf_counter() - started)
+        finally:
+            self.save()
+
+    def verify(self):
+        """(size, crc32) of the download as received.
+
+        Raises ValueError unless the finished ranges cover the file from 0
+        to the length the server gave, with no gaps.
+        """
+        size = crc = 0
+        for start, pos, end, range_crc in sorted(self.ranges):
+            if start != size:
+                raise ValueError(f"bytes {size}-{start} were never fetched")
+            if end is not None and pos != end:
+                raise ValueError(f"bytes {pos}-{end} were never fetched")
+            crc = _crc32_combine(crc, range_crc, pos - start)
+            size = pos
+        if self.length is not None and size != self.length:
+            raise ValueError(f"got {size} bytes, expected {self.length}")
+        # An attempt that died before saving its progress may have written past it
+        if os.path.getsize(self.path) > size:
+            os.truncate(self.path, size)
+        return size, crc
+
+    def discard(self):
+        for path in (self.path, self.path + '.json'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _gf2_times(matrix, vector):
+    total = 0
+    for row in matrix:
+        if not vector:
+            break
+        if vector & 1:
+            total ^= row
+        vector >>= 1
+    return total
+
+
+def _crc32_combine(crc1, crc2, length2):
+    """CRC-32 of a + b from crc32(a), crc32(b) and len(b), without the data (zlib's crc32_combine)."""
+    if length2 <= 0:
+        return crc1
+    # Operator for one zero bit, squared to two and then four zero bits
+    odd = [0xedb88320] + [1 << n for n in range(31)]
+    even = [_gf2_times(odd, row) for row in odd]
+    odd = [_gf2_times(even, row) for row in even]
+    # Apply length2 zero bytes to crc1, one bit of length2 at a time
+    while length2:
+        even = [_gf2_times(odd, row) for row in odd]
+        if length2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+        odd = [_gf2_times(even, row) for row in even]
+        if length2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        length2 >>= 1
+    return crc1 ^ crc2
+
+
+def _stored_crc(zipf, name):
+    """CRC-32 of name's content in zipf; a deduplicated member's is put together from its blobs'."""
+    info = zipf.getinfo(name)
+    if not dedup.is_pointer(info):
+        return info.CRC
+    crc = 0
+    for blob in zipf.read(info).decode().split():
+        blob_info = zipf.getinfo(blob)
+        crc = _crc32_combine(crc, blob_info.CRC, blob_info.file_size)
+    return crc
+
+
+def _client_error(error):
+    """True for a 4xx answer, which asking again won't change."""
+    response = getattr(error, 'response', None)
+    return response is not None and 400 <= response.status_code < 500
+
+
+def download_resumable(memory, url, name, parts=PARTS, buffer_size=BUFFER_SIZE, progress=None,
+                       session=SESSION):
+    """Download one file through a resumable .part file, then store it. Returns a DownloadResult.
+
+    An earlier attempt at the same URL is continued with Range requests
+    (If-Range makes the server send everything again if the file changed).
+    Big files on servers that accept ranges are fetched as parts parallel
+    ranges, and a broken connection is retried from where it stopped
+    (a 4xx answer is not retried). The finished ranges must cover the
+    expected length, and the stored copy's CRC must match the one taken
+    as the bytes came in; otherwise nothing is stored (and a .part whose
+    CRC is off is dropped, to be fetched again).
+
+    progress, if given, is called as progress(done, total, fresh, seconds)
+    a few times a second; total is None when the server doesn't say.
+    """
+    start = time.perf_counter()
+    partial = None
+    try:
+        head = session.head(url, headers=_IDENTITY)
+        # Some servers refuse HEAD; then nothing is known up front
+        headers = head.headers if head.ok else {}
+        if 'image' not in headers.get('Content-Type', 'image'):
+            raise ValueError("not an image")
+        length = int(headers['Content-Length']) if 'Content-Length' in headers else None
+        etag = headers.get('ETag', '')
+        validator = etag if etag and not etag.startswith('W/') else headers.get('Last-Modified')
+        ranged = headers.get('Accept-Ranges') == 'bytes'
+        partial = PartialDownload(url, name)
+        if not (ranged and partial.resume(length, validator)):
+            partial.begin(length, validator, parts if ranged and length and length >= SPLIT_MIN else 1)
+        for attempt in range(RESUME_ATTEMPTS + 1):
+            try:
+                partial.fetch(session, buffer_size, progress)
+                break
+            except _RangeIgnored:
+                partial.begin(length, validator, 1)
+            except (requests.RequestException, OSError) as e:
+                if attempt == RESUME_ATTEMPTS or _client_error(e):
+                    raise
+                time.sleep(RESUME_DELAY)
+        size, crc = partial.verify()
+        with memory.transaction() as tx:
+            tx.write_file(partial.path, name)
+            # Raising here rolls the write back
+            if _stored_crc(tx.zipf, name) != crc:
+                partial.discard()
+                raise ValueError("CRC of the stored copy doesn't match the download")
+        partial.discard()
+        return DownloadResult(url, name, True, size, None, time.perf_counter() - start)
+    except Exception as e:
+        # What was fetched stays in the .part for the next attempt; nothing fetched, nothing kept
+        if partial and not partial.done():
+            partial.discard()
+        return DownloadResult(url, name, False, partial.done() if partial else 0, str(e),
+                              time.perf_counter() - start)
@@ -1,7 +1,20 @@
 import os
-import zipfile
+import codecs
+import fnmatch
+import itertools
+import shlex
 import subprocess
+import time
 import winreg
+import compresspolicy
+import history
+import searchindex
+import metrics
+from commands import CommandError, command, help_command, parse_args, run_from_menu, stats_command
+from memorystore import MemoryStore
+
+# Lines shown per page by 'read NAME --page N'
+PAGE_LINES = 40
 
 def get_default_program(file_extension):
     """Fetch the default program associated with a file extension on Windows."""
@@ -23,52 +36,114 @@ def get_default_program(file_extension):
         print(f"Error accessing the registry for .{file_extension}: {e}")
         return None
 
-def store_file_in_zip(zip_filename, file_path):
+def store_file_in_zip(memory, file_path, compression=None):
     """Store a file in the zip archive."""
-    with zipfile.ZipFile(zip_filename, 'a') as zipf:
-        zipf.write(file_path, os.path.basename(file_path))
+    memory.write_file(file_path, compression=compression)
 
-def extract_file_from_zip(zip_filename, file_name, extract_to='.'):
-    """Extract a file from the zip archive."""
-    with zipfile.ZipFile(zip_filename, 'r') as zipf:
-        zipf.extract(file_name, extract_to)
+def walk_directory(root, include=None, exclude=None):
+    """Yield (path, name in memory) for every file under root that passes the glob filters.
+
+    Names keep the directory structure, starting with root's own name.
+    Patterns are matched against both the relative path and the base name.
+    """
+    base = os.path.dirname(os.path.abspath(root))
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, base).replace(os.sep, '/')
+            if include and not _matches(name, include):
+                continue
+            if exclude and _matches(name, exclude):
+                continue
+            yield path, name
+
+def _matches(name, patterns):
+    return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(name.rsplit('/', 1)[-1], p) for p in patterns)
+
+def import_directory(memory, root, include=None, exclude=None, workers=None, compression=None):
+    """Store a whole directory tree, compressing in parallel. Returns (files, bytes, seconds)."""
+    start = time.perf_counter()
+    count, size = memory.write_many(walk_directory(root, include, exclude), workers, compression)
+    return count, size, time.perf_counter() - start
 
-def remove_file_from_local(zip_filename, file_name):
-    """Remove a file from the zip archive."""
-    with zipfile.ZipFile(zip_filename, 'r') as zipf:
-        file_list = zipf.namelist()
+def parse_add_args(text):
+    """Split 'PATH [--include GLOB]... [--exclude GLOB]... [--compress CODEC]' into a path and options."""
+    parts = shlex.split(text)
+    path, include, exclude, compression = [], [], [], None
+    while parts:
+        part = parts.pop(0)
+        if part in ('--include', '--exclude') and parts:
+            (include if part == '--include' else exclude).append(parts.pop(0))
+        elif part == '--compress' and parts:
+            compression = parts.pop(0)
+            if compression not in compresspolicy.POLICIES:
+                raise ValueError(f"Unknown codec {compression}")
+        else:
+            path.append(part)
+    return ' '.join(path), include, exclude, compression
+
+def extract_file_from_zip(memory, file_name, extract_to='.'):
+    """Extract a file from the zip archive."""
+    memory.extract(file_name, extract_to)
 
-    if file_name in file_list:
-        with zipfile.ZipFile(zip_filename, 'w') as zipf:
-            for f in file_list:
-                if f != file_name:
-                    zipf.write(f)
+def remove_file_from_local(memory, file_name):
+    """Remove a file from the zip archive (tombstoned, the space is reclaimed by compaction)."""
+    return memory.remove(file_name)
 
-def overwrite_file(zip_filename, old_file_name, new_file_path):
+def overwrite_file(memory, old_file_name, new_file_path):
     """Overwrite a file in the archive."""
-    remove_file_from_local(zip_filename, old_file_name)
-    store_file_in_zip(zip_filename, new_file_path)
+    memory.replace_file(old_file_name, new_file_path)
 
-def read_file_from_local(zip_filename, file_name):
-    """Read (print) the content of a file from the zip archive."""
-    with zipfile.ZipFile(zip_filename, 'r') as zipf:
-        zipf.extract(file_name, 'temp')
-    
+def read_file_from_local(memory, file_name, page=None, head=None, tail=None, byte_range=None):
+    """Read (print) the content of a file from the zip archive.
+
+    The file is streamed straight out of the archive, so only one chunk is
+    held in memory however big it is. page/head/tail select lines and
+    byte_range is a (start, end) pair of byte offsets.
+    """
     try:
-        with open(f'temp/{file_name}', 'r') as f:
-            print(f.read())
+        if byte_range is not None:
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            for chunk in memory.iter_chunks(file_name, *byte_range):
+                print(decoder.decode(chunk), end='')
+            print(decoder.decode(b'', final=True))
+            return
+        if tail is not None:
+            lines = memory.tail_lines(file_name, tail)
+        else:
+            lines = memory.iter_lines(file_name)
+            if page is not None:
+                lines = itertools.islice(lines, (page - 1) * PAGE_LINES, page * PAGE_LINES)
+            elif head is not None:
+                lines = itertools.islice(lines, head)
+        for line in lines:
+            print(line, end='')
+        print()
     except UnicodeDecodeError:
         print("This is a binary file, cannot print its content.")
-    finally:
-        os.remove(f'temp/{file_name}')
 
-def edit_file(zip_filename, file_name, new_data):
-    """Edit a file's content inside the archive."""
-    remove_file_from_local(zip_filename, file_name)
-    with open('temp_file', 'w') as f:
-        f.write(new_data)  # Assuming text data for simplicity
-    store_file_in_zip(zip_filename, 'temp_file')
-    os.remove('temp_file')
+def parse_read_args(text):
+    """Split 'NAME [--page N | --head N | --tail N | --bytes START:END]' into a name and options."""
+    parts = text.split()
+    options = {}
+    while len(parts) >= 3 and parts[-2] in ('--page', '--head', '--tail', '--bytes'):
+        flag, value = parts[-2], parts[-1]
+        if flag == '--bytes':
+            start, _, end = value.partition(':')
+            options['byte_range'] = (int(start or 0), int(end) if end else None)
+            if options['byte_range'][0] < 0 or (end and int(end) < 0):
+                raise ValueError(f"{flag} offsets can't be negative")
+        else:
+            options[flag[2:]] = int(value)
+            if options[flag[2:]] < 1:
+                raise ValueError(f"{flag} needs a number of at least 1")
+        parts = parts[:-2]
+    return ' '.join(parts), options
+
+def edit_file(memory, file_name, new_data):
+    """Edit a file's content inside the archive, keeping the old content in its history."""
+    history.save(memory, file_name, new_data, "edit")  # Assuming text data for simplicity
 
 def open_file_with_program(file_path):
     """Open the file using the default program for its extension."""
@@ -88,71 +163,215 @@ def open_file_with_program(file_path):
         except Exception as e:
             print(f"Failed to open {file_path} with the system default: {e}")
 
-def open_extracted_file(zip_filename, file_name):
+def open_extracted_file(memory, file_name):
     """Extract the file and open it with the default program."""
-    extract_file_from_zip(zip_filename, file_name)
+    extract_file_from_zip(memory, file_name)
     open_file_with_program(file_name)
 
-def wipe_memory(zip_filename):
+def list_memory(memory):
+    """Print every file with its size and the space it takes in the archive."""
+    rows = memory.listing()
+    if not rows:
+        print("Memory is empty.")
+        return
+    width = max(len(name) for name, _, _, _ in rows)
+    for name, size, packed, codec in rows:
+        ratio = packed / size * 100 if size else 100
+        print(f"{name:<{width}}  {size:>12,} B  {packed:>12,} B  {ratio:5.1f}%  {codec}")
+
+def wipe_memory(memory):
     """Delete all files from the zip archive."""
     try:
-        with zipfile.ZipFile(zip_filename, 'w') as zipf:
-            pass  # Opening in 'w' mode clears the existing content of the zip file
-        print("All files have been deleted from memory.")
+        wipe_command(memory, "--yes")
     except Exception as e:
         print(f"Error while wiping memory: {e}")
 
-def main():
+# Non-interactive commands, for sussy.run("filemanager ...") and batch files
+
+help_command("filemanager")
+stats_command("filemanager")
+
+def _need(memory, file_name):
+    if file_name not in memory:
+        raise CommandError(f"File {file_name} not found in memory")
+
+@command("filemanager", "add", "PATH [--include GLOB]... [--exclude GLOB]... [--compress CODEC]")
+def add_command(memory, args):
+    file_path, include, exclude, compression = parse_add_args(args)
+    if os.path.isfile(file_path):
+        store_file_in_zip(memory, file_path, compression)
+        print(f"File {file_path} added to local storage.")
+        return {'files': 1, 'bytes': os.path.getsize(file_path)}
+    if os.path.isdir(file_path):
+        count, size, seconds = import_directory(memory, file_path, include, exclude, compression=compression)
+        seconds = max(seconds, 1e-9)
+        print(f"{count} files ({size / 1e6:.1f} MB) from {file_path} added to local storage "
+              f"in {seconds:.2f}s: {count / seconds:.0f} files/s, {size / 1e6 / seconds:.1f} MB/s.")
+        return {'files': count, 'bytes': size}
+    raise CommandError(f"File {file_path} not found")
+
+@command("filemanager", "remove", "NAME")
+def remove_command(memory, args):
+    if not remove_file_from_local(memory, args):
+        raise CommandError(f"File {args} not found in memory")
+    print(f"File {args} removed from local storage.")
+    return True
+
+@command("filemanager", "overwrite", "NAME NEW_PATH")
+def overwrite_command(memory, args):
+    old_file_name, new_file_path = parse_args(args, "filemanager overwrite NAME NEW_PATH", str, str)
+    if not os.path.isfile(new_file_path):
+        raise CommandError(f"New file {new_file_path} not found")
+    overwrite_file(memory, old_file_name, new_file_path)
+    print(f"File {old_file_name} overwritten with {new_file_path}.")
+    return True
+
+@command("filemanager", "read", "NAME [--page N | --head N | --tail N | --bytes START:END]")
+def read_command(memory, args):
+    file_name, options = parse_read_args(args)
+    _need(memory, file_name)
+    read_file_from_local(memory, file_name, **options)
+
+@command("filemanager", "edit", "NAME NEW CONTENT")
+def edit_command(memory, args):
+    file_name, _, new_data = args.partition(' ')
+    edit_file(memory, file_name, new_data)
+    print(f"File {file_name} edited.")
+    return len(new_data.encode('utf-8'))
+
+@command("filemanager", "extract", "NAME [DIRECTORY]")
+def extract_command(memory, args):
+    file_name, _, directory = args.partition(' ')
+    _need(memory, file_name)
+    path = memory.extract(file_name, directory.strip() or '.')
+    print(f"File {file_name} extracted to {path}.")
+    return path
+
+@command("filemanager", "open", "NAME")
+def open_command(memory, args):
+    _need(memory, args)
+    open_extracted_file(memory, args)
+
+@command("filemanager", "list")
+def list_command(memory, args):
+    list_memory(memory)
+    return [{'name': name, 'size': size, 'packed': packed, 'codec': codec}
+            for name, size, packed, codec in memory.listing()]
+
+@command("filemanager", "find", 'WORD... | "PHRASE"')
+def find_command(memory, args):
+    hits = searchindex.find(memory, args)
+    return [{'name': name, 'line': number, 'text': text} for name, number, text in hits]
+
+@command("filemanager", "history", "NAME")
+def history_command(memory, args):
+    return history.show_history(memory, args)
+
+@command("filemanager", "diff", "NAME REV1 REV2")
+def diff_command(memory, args):
+    file_name, old, new = parse_args(args, "filemanager diff NAME REV1 REV2",
+                                     str, history.parse_rev, history.parse_rev)
+    try:
+        return history.show_diff(memory, file_name, old, new)
+    except KeyError as e:
+        raise CommandError(e.args[0])
+
+@command("filemanager", "revert", "NAME REV")
+def revert_command(memory, args):
+    file_name, rev = parse_args(args, "filemanager revert NAME REV", str, history.parse_rev)
+    try:
+        return history.revert(memory, file_name, rev)
+    except KeyError as e:
+        raise CommandError(e.args[0])
+
+@command("filemanager", "wipe", "--yes")
+def wipe_command(memory, args):
+    if args != "--yes":
+        raise CommandError("Wipe deletes everything, confirm with 'filemanager wipe --yes'")
+    memory.wipe()
+    print("All files have been deleted from memory.")
+    return True
+
+@command("filemanager", "compact")
+def compact_command(memory, args):
+    """Reclaim the space left behind by removed and overwritten files."""
+    reclaimed = memory.compact()
+    print(f"Memory compacted, {reclaimed} bytes reclaimed.")
+    return reclaimed
+
+def main(memory=None):
     print("FILE MANAGER")
-    zip_filename = 'memory.zip'
+    if memory is None:
+        memory = MemoryStore()
 
     while True:
-        print("\nCommands: add, remove, overwrite, read, edit, open, wipe, exit")
-        command = input("Enter command: ").strip().lower()
+        print("\nCommands: add, remove, overwrite, read, edit, open, list, find, history, diff, revert, wipe, compact, exit")
+        command, _, args = input("Enter command: ").strip().partition(' ')
+        command = command.lower()
 
         if command == 'add':
-            file_path = input("Enter the path of the file to add: ").strip()
-            if os.path.isfile(file_path):
-                store_file_in_zip(zip_filename, file_path)
-                print(f"File {file_path} added to local storage.")
-            else:
-                print("File not found!")
+            # add PATH [--compress CODEC], or add DIR [--include GLOB] [--exclude GLOB] for a whole tree
+            target = args.strip() or input("Enter the path of the file to add: ").strip()
+            try:
+                run_from_menu("filemanager", 'add', memory, target)
+            except ValueError:
+                print("Invalid add options!")
 
         elif command == 'remove':
             file_name = input("Enter the file name to remove: ").strip()
-            remove_file_from_local(zip_filename, file_name)
-            print(f"File {file_name} removed from local storage.")
+            run_from_menu("filemanager", 'remove', memory, file_name)
 
         elif command == 'overwrite':
             old_file_name = input("Enter the file name to overwrite: ").strip()
             new_file_path = input("Enter the path of the new file: ").strip()
-            if os.path.isfile(new_file_path):
-                overwrite_file(zip_filename, old_file_name, new_file_path)
-                print(f"File {old_file_name} overwritten with {new_file_path}.")
-            else:
-                print("New file not found!")
+            run_from_menu("filemanager", 'overwrite', memory, shlex.join([old_file_name, new_file_path]))
 
         elif command == 'read':
-            file_name = input("Enter the file name to read: ").strip()
-            read_file_from_local(zip_filename, file_name)
+            # read NAME [--page N | --head N | --tail N | --bytes START:END]
+            target = args.strip() or input("Enter the file name to read: ").strip()
+            try:
+                run_from_menu("filemanager", 'read', memory, target)
+            except ValueError:
+                print("Invalid read options!")
 
         elif command == 'edit':
             file_name = input("Enter the file name to edit: ").strip()
             new_data = input("Enter the new content: ")
-            edit_file(zip_filename, file_name, new_data)
+            with metrics.timed("filemanager edit"):
+                edit_file(memory, file_name, new_data)
             print(f"File {file_name} edited.")
 
         elif command == 'open':
             file_name = input("Enter the file name to open: ").strip()
-            open_extracted_file(zip_filename, file_name)
+            run_from_menu("filemanager", 'open', memory, file_name)
+
+        elif command == 'list':
+            run_from_menu("filemanager", 'list', memory, '')
+
+        elif command == 'find':
+            # find WORD... or find "a phrase": files and line numbers, from the index
+            query = args.strip() or input("Enter what to find: ").strip()
+            run_from_menu("filemanager", 'find', memory, query)
+
+        elif command == 'history':
+            file_name = args.strip() or input("Enter the file name: ").strip()
+            run_from_menu("filemanager", 'history', memory, file_name)
+
+        elif command in ('diff', 'revert'):
+            # diff NAME REV1 REV2, revert NAME REV (revisions as r3 or 3)
+            run_from_menu("filemanager", command, memory, args)
 
         elif command == 'wipe':
             confirm = input("Are you sure you want to delete everything? (y/n): ").strip().lower()
             if confirm == 'y':
-                wipe_memory(zip_filename)
+                with metrics.timed("filemanager wipe"):
+                    wipe_memory(memory)
             else:
                 print("Wipe operation canceled.")
 
+        elif command == 'compact':
+            run_from_menu("filemanager", 'compact', memory, '')
+
         elif command == 'exit':
             print("Exiting program.")
             break
@@ -0,0 +1,218 @@
+import difflib
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Revisions are kept next to memory.zip, one directory per member
+HISTORY_DIR = os.path.join(".sussy", "history")
+# Every revision is a line delta against its parent, except that a full
+# snapshot is stored at least this often, so rebuilding one never applies
+# more than this many deltas
+SNAPSHOT_EVERY = 16
+# Only text members up to this size get a history
+MAX_TRACKED_SIZE = 4 * 1024 * 1024
+
+
+def parse_rev(text):
+    """Revision number from 'r3' or '3'."""
+    return int(text[1:] if text[:1] in ('r', 'R') else text)
+
+
+def _delta(old, new):
+    """Line ops turning old into new: ['=', n] keep, ['-', n] drop, ['+', lines] insert."""
+    ops = []
+    matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append(['=', i2 - i1])
+            continue
+        if i2 > i1:
+            ops.append(['-', i2 - i1])
+        if j2 > j1:
+            ops.append(['+', new[j1:j2]])
+    return ops
+
+
+def _apply(lines, ops):
+    result = []
+    pos = 0
+    for op, arg in ops:
+        if op == '=':
+            result.extend(lines[pos:pos + arg])
+            pos += arg
+        elif op == '-':
+            pos += arg
+        else:
+            result.extend(arg)
+    return result
+
+
+class History:
+    """Revisions of memory members, stored as line deltas under directory.
+
+    Each member has its own directory with head.json (latest revision and
+    latest snapshot) and one rN.json per revision. A revision is either a
+    snapshot of all its lines or a delta against its parent; checking one
+    out reads back to the nearest snapshot and applies the deltas from
+    there, so the cost depends on that chain, not on how many revisions
+    exist.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def _dir(self, name):
+        return os.path.join(self.directory, hashlib.sha256(name.encode('utf-8')).hexdigest()[:20])
+
+    def _load(self, name, filename):
+        try:
+            with open(os.path.join(self._dir(name), filename), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _save(self, name, filename, value):
+        path = os.path.join(self._dir(name), filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(value, f, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+
+    def head(self, name):
+        """Latest revision number of name, None if it has no history."""
+        head = self._load(name, 'head.json')
+        return head['head'] if head else None
+
+    def _lines(self, name, rev):
+        chain = []
+        while True:
+            record = self._load(name, f"r{rev}.json")
+            if record is None:
+                raise KeyError(f"{name} has no revision r{rev}")
+            if 'snapshot' in record:
+                lines = record['snapshot']
+                break
+            chain.append(record['delta'])
+            rev = record['parent']
+        for ops in reversed(chain):
+            lines = _apply(lines, ops)
+        return lines
+
+    def checkout(self, name, rev):
+        """Content of name at revision rev, as bytes."""
+        return ''.join(self._lines(name, rev)).encode('utf-8')
+
+    def record(self, name, data, note=''):
+        """Add data as the next revision of name. Returns its number, or None if not recorded.
+
+        Nothing is recorded for binary or oversized data, or when data is
+        the same as the latest revision.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if len(data) > MAX_TRACKED_SIZE:
+            return None
+        try:
+            lines = data.decode('utf-8').splitlines(keepends=True)
+        except UnicodeDecodeError:
+            return None
+        with self._lock:
+            head = self._load(name, 'head.json') or {'name': name, 'head': 0, 'snapshot': 0}
+            rev = head['head'] + 1
+            record = {'rev': rev, 'time': time.time(), 'size': len(data), 'note': note}
+            if head['head']:
+                parent = self._lines(name, head['head'])
+                if parent == lines:
+                    return None
+                ops = _delta(parent, lines)
+                record['added'] = sum(len(arg) for op, arg in ops if op == '+')
+                record['removed'] = sum(arg for op, arg in ops if op == '-')
+                inserted = sum(len(line) for op, arg in ops if op == '+' for line in arg)
+                # A delta that rewrites most of the file is no cheaper than a snapshot
+                if rev - head['snapshot'] < SNAPSHOT_EVERY and inserted < len(data) // 2:
+                    record['parent'], record['delta'] = head['head'], ops
+            else:
+                record['added'], record['removed'] = len(lines), 0
+            if 'delta' not in record:
+                record['snapshot'] = lines
+                head['snapshot'] = rev
+            self._save(name, f"r{rev}.json", record)
+            head['head'] = rev
+            self._save(name, 'head.json', head)
+            return rev
+
+    def revisions(self, name):
+        """Records of every revision of name, oldest first, without their content."""
+        head = self.head(name) or 0
+        records = [self._load(name, f"r{rev}.json") for rev in range(1, head + 1)]
+        return [{key: value for key, value in record.items() if key not in ('snapshot', 'delta')}
+                for record in records]
+
+    def diff(self, name, old, new):
+        """Unified diff lines from revision old to revision new of name."""
+        return list(difflib.unified_diff(self._lines(name, old), self._lines(name, new),
+                                         f"{name}@r{old}", f"{name}@r{new}"))
+
+
+_histories = {}
+_histories_guard = threading.Lock()
+
+
+def history_for(memory):
+    """The History kept next to memory's archive."""
+    directory = os.path.join(os.path.dirname(os.path.abspath(memory.path)), HISTORY_DIR)
+    with _histories_guard:
+        return _histories.setdefault(directory, History(directory))
+
+
+def save(memory, name, data, note=''):
+    """Write data to name in memory and record it as a new revision.
+
+    A member edited for the first time gets its current content recorded
+    first, so its first change can be diffed and reverted too. So does one
+    that was changed without going through here since its last revision
+    (e.g. added again), so that version isn't lost.
+    """
+    history = history_for(memory)
+    if name in memory and memory.size(name) <= MAX_TRACKED_SIZE:
+        head = history.head(name)
+        current = memory.read(name)
+        if head is None:
+            history.record(name, current, 'before history')
+        elif current != history.checkout(name, head):
+            history.record(name, current, 'changed outside history')
+    memory.write(name, data)
+    return history.record(name, data, note)
+
+
+def show_history(memory, name):
+    """Print and return the revisions of name."""
+    revisions = history_for(memory).revisions(name)
+    if not revisions:
+        print(f"No history for {name}.")
+    for record in revisions:
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['time']))
+        print(f"r{record['rev']}  {stamp}  {record['size']:>10,} B  "
+              f"+{record['added']} -{record['removed']}  {record['note']}".rstrip())
+    return revisions
+
+
+def show_diff(memory, name, old, new):
+    """Print and return the unified diff between two revisions of name."""
+    lines = history_for(memory).diff(name, old, new)
+    for line in lines:
+        print(line, end='' if line.endswith('\n') else '\n')
+    if not lines:
+        print(f"r{old} and r{new} of {name} are the same.")
+    return lines
+
+
+def revert(memory, name, rev):
+    """Make revision rev of name its current content again, as a new revision. Returns that revision."""
+    data = history_for(memory).checkout(name, rev)
+    new = save(memory, name, data, f"revert to r{rev}")
+    print(f"{name} reverted to r{rev}" + (f" (now r{new})." if new else ", it was already the same."))
+    return new
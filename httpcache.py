@@ -0,0 +1,258 @@
+import calendar
+import collections
+import email.utils
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+import metrics
+
+# Cached responses live here, next to memory.zip
+CACHE_DIR = "httpcache"
+CACHE_INDEX = "index.json"
+# Least recently used entries are dropped past this many bytes of bodies
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Responses with a Last-Modified but no explicit lifetime stay fresh for this
+# share of their age (the usual heuristic), but never longer than a day
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX_AGE = 24 * 60 * 60
+
+# Connection pools kept per host, and connections kept open in each
+POOL_CONNECTIONS = 16
+POOL_MAXSIZE = 8
+RETRIES = 2
+# (connect, read) seconds
+TIMEOUT = (5, 30)
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+
+# Not stored: they describe the connection or the encoded body, and the
+# cached body is the decoded one
+_SKIP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'content-encoding',
+                 'content-length', 'set-cookie', 'age'}
+
+
+def make_session(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, retries=RETRIES):
+    """requests.Session with keep-alive pools and retries on flaky gateways."""
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.3, status_forcelist=(502, 503, 504),
+                  allowed_methods=frozenset(['GET', 'HEAD']))
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    return session
+
+
+def _http_date(value):
+    """Seconds since the epoch for an HTTP date header, None if it doesn't parse."""
+    try:
+        return calendar.timegm(email.utils.parsedate_to_datetime(value).utctimetuple())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _cache_control(headers):
+    directives = {}
+    for part in headers.get('Cache-Control', '').split(','):
+        key, _, value = part.strip().partition('=')
+        if key:
+            directives[key.lower()] = value.strip('"')
+    return directives
+
+
+def freshness(headers, now=None):
+    """How many seconds a response may be reused without asking the server again.
+
+    None means it mustn't be stored at all.
+    """
+    now = time.time() if now is None else now
+    directives = _cache_control(headers)
+    if 'no-store' in directives or headers.get('Vary', '').strip() == '*':
+        return None
+    if 'no-cache' in directives:
+        return 0
+    if re.fullmatch(r'\d+', directives.get('max-age', '')):
+        return int(directives['max-age'])
+    date = _http_date(headers.get('Date')) or now
+    if 'Expires' in headers:
+        expires = _http_date(headers['Expires'])
+        return max(expires - date, 0) if expires is not None else 0
+    modified = _http_date(headers.get('Last-Modified'))
+    if modified is not None:
+        return min((date - modified) * HEURISTIC_FRACTION, HEURISTIC_MAX_AGE)
+    return 0
+
+
+class HttpCache:
+    """On-disk cache of GET responses with an LRU size cap.
+
+    Bodies are files named by the sha256 of their URL; index.json keeps
+    each entry's headers, validators (ETag/Last-Modified) and expiry time,
+    in least recently used first order.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = None  # url -> entry dict, loaded on first use
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(os.path.join(self.directory, CACHE_INDEX), encoding='utf-8') as f:
+                    self._entries = collections.OrderedDict(json.load(f))
+            except (OSError, ValueError):
+                self._entries = collections.OrderedDict()
+            # The cap may have been lowered since the last session
+            self._evict()
+        return self._entries
+
+    def _save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, CACHE_INDEX)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(list(self._entries.items()), f)
+        os.replace(path + '.tmp', path)
+
+    def _body_path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest())
+
+    def lookup(self, url):
+        """(entry, body) cached for url, or (None, None)."""
+        with self._lock:
+            entry = self._load().get(url)
+            if entry is None:
+                return None, None
+            try:
+                with open(self._body_path(url), 'rb') as f:
+                    body = f.read()
+            except OSError:
+                del self._entries[url]
+                return None, None
+            self._entries.move_to_end(url)
+            return entry, body
+
+    def store(self, url, response):
+        """Cache a 200 response if its headers allow it."""
+        lifetime = freshness(response.headers)
+        if lifetime is None:
+            return
+        headers = {key: value for key, value in response.headers.items() if key.lower() not in _SKIP_HEADERS}
+        body = response.content
+        with self._lock:
+            entries = self._load()
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._body_path(url), 'wb') as f:
+                f.write(body)
+            entries.pop(url, None)
+            entries[url] = {'headers': headers, 'size': len(body), 'expires': time.time() + lifetime}
+            self._evict()
+            self._save()
+
+    def revalidated(self, url, response):
+        """The server answered 304: take its new headers and start a new lifetime."""
+        with self._lock:
+            entry = self._load().get(url)
+            if entry is None:
+                return
+            entry['headers'].update((key, value) for key, value in response.headers.items()
+                                    if key.lower() not in _SKIP_HEADERS)
+            lifetime = freshness(CaseInsensitiveDict(entry['headers']))
+            entry['expires'] = time.time() + (lifetime or 0)
+            self._save()
+
+    def _evict(self):
+        total = sum(entry['size'] for entry in self._entries.values())
+        while total > self.max_bytes and self._entries:
+            url, entry = self._entries.popitem(last=False)
+            total -= entry['size']
+            try:
+                os.remove(self._body_path(url))
+            except OSError:
+                pass
+
+    def size(self):
+        with self._lock:
+            return sum(entry['size'] for entry in self._load().values())
+
+    def clear(self):
+        with self._lock:
+            for url in self._load():
+                try:
+                    os.remove(self._body_path(url))
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._save()
+
+
+def _cached_response(url, entry, body):
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = 'OK'
+    response.url = url
+    response.headers = CaseInsensitiveDict(entry['headers'])
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response._content = body
+    return response
+
+
+class CachedSession:
+    """The shared HTTP client: one pooled session behind an HttpCache.
+
+    get() answers fresh entries from disk without touching the network,
+    revalidates stale ones with If-None-Match/If-Modified-Since (a 304 reuses
+    the cached body) and stores cacheable 200s. Every response gets a
+    from_cache attribute: 'hit', 'revalidated' or False.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, session=None):
+        self.session = session or make_session()
+        self.cache = HttpCache(cache_dir, max_bytes)
+
+    def get(self, url, params=None, headers=None, timeout=TIMEOUT):
+        request = self.session.prepare_request(requests.Request('GET', url, params=params, headers=headers))
+        entry, body = self.cache.lookup(request.url)
+        if entry is not None and time.time() < entry['expires']:
+            response = _cached_response(request.url, entry, body)
+            response.from_cache = 'hit'
+            metrics.count('http cache hits')
+            return response
+        if entry is not None:
+            cached_headers = CaseInsensitiveDict(entry['headers'])
+            if 'ETag' in cached_headers:
+                request.headers['If-None-Match'] = cached_headers['ETag']
+            if 'Last-Modified' in cached_headers:
+                request.headers['If-Modified-Since'] = cached_headers['Last-Modified']
+        settings = self.session.merge_environment_settings(request.url, {}, None, None, None)
+        response = self.session.send(request, timeout=timeout, allow_redirects=True, **settings)
+        if response.status_code == 304 and entry is not None:
+            self.cache.revalidated(request.url, response)
+            cached = _cached_response(request.url, entry, body)
+            cached.from_cache = 'revalidated'
+            metrics.count('http cache revalidated')
+            return cached
+        response.from_cache = False
+        metrics.count('http cache misses')
+        metrics.count('http bytes fetched', len(response.content))
+        if response.status_code == 200:
+            self.cache.store(request.url, response)
+        return response
+
+    def head(self, url, headers=None, timeout=TIMEOUT):
+        return self.session.head(url, headers=headers, allow_redirects=True, timeout=timeout)
+
+    def stream(self, url, headers=None, timeout=TIMEOUT):
+        """Uncached streaming GET through the same connection pools, for downloads."""
+        return self.session.get(url, headers=headers, stream=True, allow_redirects=True, timeout=timeout)
+
+
+# Shared by the browser for the whole session
+SESSION = CachedSession()
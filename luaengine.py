@@ -0,0 +1,739 @@
+import collections
+import hashlib
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from lupa import LuaRuntime, LuaError, LuaMemoryError
+import metrics
+from memorystore import MemoryStore
+
+# Warm runtimes kept ready for the next run
+POOL_SIZE = 2
+
+# Limits checked from a Lua count hook every HOOK_EVERY instructions
+HOOK_EVERY = 10000
+# Default ceilings for a single run; None switches a limit off
+MAX_INSTRUCTIONS = 2 * 10 ** 9
+MAX_MEMORY = 256 * 1024 * 1024
+# Profiling is slow, so a profiled run also gets a CPU time limit in seconds
+PROFILE_TIMEOUT = 60
+# Lua errors starting with this are limits being hit, not script bugs
+LIMIT_PREFIX = "limit exceeded: "
+# Default per-script CPU time limit for batch runs, in seconds
+BATCH_TIMEOUT = 10
+# Chunk size memory.chunks() hands to scripts by default
+BRIDGE_CHUNK = 64 * 1024
+# Extra wall time, from when a worker picked a script up, that a batch waits
+# on one whose hook never fired before giving up on it (the pool is
+# terminated at the end)
+HUNG_GRACE = 5
+# How often a batch checks its scripts for results and hung workers, in seconds
+BATCH_POLL = 0.05
+
+# Installed once per runtime. Each run loads the cached bytecode into a fresh
+# environment table, so globals a script defines never leak into the next
+# run. A script that writes to _G itself, or changes one of the standard
+# library tables or a metatable they share, marks the runtime dirty and it is
+# thrown away instead of going back to the pool.
+_PRELUDE = b'''
+local load, setmetatable, next, rawget, collectgarbage, error, pcall = load, setmetatable, next, rawget, collectgarbage, error, pcall
+local select, tostring, tonumber, concat, pack, unpack = select, tostring, tonumber, table.concat, table.pack, table.unpack
+local clock, sethook, getinfo = os.clock, debug.sethook, debug.getinfo
+local string_dump, find, sub, type, G, io = string.dump, string.find, string.sub, type, _G, io
+local create, resume = coroutine.create, coroutine.resume
+local getmetatable, ipairs = debug.getmetatable, ipairs
+
+-- debug.sethook only covers the coroutine it is called in, so while a run
+-- has limits every coroutine the script creates gets this hook as well
+local coroutine_hook
+function coroutine.create(f)
+    local thread = create(f)
+    if coroutine_hook then sethook(thread, coroutine_hook, "", HOOK_EVERY) end
+    return thread
+end
+function coroutine.wrap(f)
+    local thread = coroutine.create(f)
+    return function(...)
+        local results = pack(resume(thread, ...))
+        if not results[1] then error(results[2], 0) end
+        return unpack(results, 2, results.n)
+    end
+end
+
+-- Every run shares these tables, so clean() checks them against a copy of
+-- their members and their metatables taken now
+local string_meta = getmetatable("")
+local shared = {}
+for _, t in ipairs{G, string, table, math, os, io, coroutine, utf8, string_meta} do
+    local members = {}
+    for key, value in next, t do members[key] = value end
+    shared[t] = {members, getmetatable(t)}
+end
+
+local function compile(source, name)
+    local chunk, err = load(source, name, "t")
+    if not chunk then error(err, 0) end
+    return string_dump(chunk)
+end
+
+local function prepare(bytecode, name, out, api)
+    local env = setmetatable({}, {__index = G})
+    env.memory = api
+    if out then
+        -- print/io.write append to the out table instead of the console
+        env.print = function(...)
+            local parts = {}
+            for i = 1, select("#", ...) do parts[i] = tostring((select(i, ...))) end
+            out[#out + 1] = concat(parts, "\\t") .. "\\n"
+        end
+        env.io = setmetatable({write = function(...)
+            for i = 1, select("#", ...) do out[#out + 1] = tostring((select(i, ...))) end
+        end}, {__index = io})
+    end
+    local chunk, err = load(bytecode, name, "b", env)
+    if not chunk then error(err, 0) end
+    return chunk
+end
+
+-- The `memory` table scripts use to reach memory.zip. The arguments are the
+-- Python functions of a MemoryBridge; write is nil when the store is read-only.
+-- Members are handed over in pieces (lines, chunks, ranges, file handles) so
+-- a script can walk a huge member without holding all of it.
+local function memory_api(exists, size, names, read, lines, chunks, open, write)
+    local api = {}
+    local function need(name)
+        if type(name) ~= "string" or not exists(name) then
+            error("no file named " .. tostring(name) .. " in memory", 3)
+        end
+    end
+    function api.exists(name) return exists(name) end
+    function api.size(name) need(name); return size(name) end
+    function api.list() return names() end
+    -- offset is 0-based like file:seek; nil length reads to the end
+    function api.read(name, offset, length) need(name); return read(name, offset or 0, length) end
+    -- Python hands over blocks that end at a line feed, split here: one
+    -- Python call per block instead of one per line
+    function api.lines(name)
+        need(name)
+        local next_block, block, pos = lines(name), "", 1
+        return function()
+            while block do
+                local stop = find(block, "\\n", pos, true)
+                if stop then
+                    local line = sub(block, pos, stop - 1)
+                    pos = stop + 1
+                    if sub(line, -1) == "\\r" then line = sub(line, 1, -2) end
+                    return line
+                end
+                -- Only the last block can end without a line feed
+                if pos <= #block then
+                    local line = sub(block, pos)
+                    block = nil
+                    return line
+                end
+                block, pos = next_block(), 1
+            end
+        end
+    end
+    function api.chunks(name, chunk_size) need(name); return chunks(name, chunk_size or BRIDGE_CHUNK) end
+    function api.write(name, data)
+        if not write then error("memory is read-only here", 2) end
+        if type(name) ~= "string" or type(data) ~= "string" then
+            error("memory.write expects a name and a string", 2)
+        end
+        write(name, data)
+        return true
+    end
+    -- A read-only handle that works like the ones io.open returns
+    function api.open(name)
+        if type(name) ~= "string" or not exists(name) then return nil, tostring(name) .. ": no such file in memory" end
+        local f_read, f_readline, f_readall, f_seek, f_close = open(name)
+        local function read_one(fmt)
+            if type(fmt) == "number" then return f_read(fmt) end
+            fmt = tostring(fmt):gsub("^%*", ""):sub(1, 1)
+            if fmt == "l" then return f_readline(false) end
+            if fmt == "L" then return f_readline(true) end
+            if fmt == "a" then return f_readall() end
+            error("bad read format " .. fmt, 3)
+        end
+        local file = {}
+        function file:read(...)
+            local count = select("#", ...)
+            if count == 0 then return read_one("l") end
+            local values = {}
+            for i = 1, count do
+                values[i] = read_one((select(i, ...)))
+                if values[i] == nil then return unpack(values, 1, i) end
+            end
+            return unpack(values, 1, count)
+        end
+        function file:lines(fmt)
+            fmt = fmt or "l"
+            return function() return read_one(fmt) end
+        end
+        function file:seek(whence, offset)
+            whence, offset = whence or "cur", tonumber(offset or 0)
+            if whence ~= "set" and whence ~= "cur" and whence ~= "end" then
+                error("bad seek whence " .. tostring(whence), 2)
+            end
+            if not offset then error("bad seek offset", 2) end
+            return f_seek(whence, offset)
+        end
+        function file:close() f_close(); return true end
+        return file
+    end
+    return api
+end
+
+-- Returns check(steps), to call as instructions run, and tripped(). check
+-- raises once a limit is hit and on every call after that, so a pcall in
+-- the script can't swallow the limit; tripped() gives the reason, if any.
+local function limiter(timeout, instructions)
+    local stop = timeout and clock() + timeout
+    local count, reason = 0, nil
+    local function check(steps)
+        if not reason then
+            count = count + steps
+            if stop and clock() > stop then
+                reason = "LIMIT_PREFIXran longer than " .. timeout .. "s"
+            elseif instructions and count > instructions then
+                reason = "LIMIT_PREFIXmore than " .. instructions .. " instructions"
+            end
+        end
+        if reason then error(reason, 0) end
+    end
+    return check, function() return reason end
+end
+
+-- Count hook calling check every HOOK_EVERY instructions. Once the limit
+-- trips it fires on every instruction of that coroutine, so even a loop of
+-- pcalls errors out at its first instruction outside them. It never raises
+-- inside this prelude, which has to get to clearing the hooks.
+local function counting(check)
+    local hook
+    hook = function()
+        local ok, err = pcall(check, HOOK_EVERY)
+        if not ok then
+            sethook(hook, "", 1)
+            if getinfo(2, "S").source ~= "=luaengine" then error(err, 0) end
+        end
+    end
+    return hook
+end
+
+local function finish(results, tripped)
+    sethook()
+    coroutine_hook = nil
+    local reason = tripped and tripped()
+    if reason then error(reason, 0) end
+    if not results[1] then error(results[2], 0) end
+    return unpack(results, 2, results.n)
+end
+
+-- out: table collecting the script's output (nil prints to the console)
+-- timeout: CPU seconds, instructions: instruction count; nil for no limit
+local function run(bytecode, name, out, api, timeout, instructions)
+    local chunk = prepare(bytecode, name, out, api)
+    local tripped
+    if timeout or instructions then
+        local check
+        check, tripped = limiter(timeout, instructions)
+        coroutine_hook = counting(check)
+        sethook(coroutine_hook, "", HOOK_EVERY)
+    end
+    return finish(pack(pcall(chunk)), tripped)
+end
+
+-- Runs the chunk under call/return/line hooks and returns the script's
+-- results followed by two tables: per line and per function {hits, seconds}.
+-- Time is self time: the clock between two hook events goes to the line
+-- and the function that were running.
+local function profile(bytecode, name, out, api, timeout, instructions)
+    local chunk = prepare(bytecode, name, out, api)
+    -- Count events don't fire alongside line events, so limits are checked
+    -- per line instead (a line is at least one instruction). Coroutines the
+    -- script creates are only limited, not profiled.
+    local check, tripped = limiter(timeout, instructions)
+    coroutine_hook = counting(check)
+    local lines, funcs, stack = {}, {}, {}
+    local started, done, last_line, last_time = false, false, nil, nil
+
+    local function stat(t, key)
+        local s = t[key]
+        if not s then s = {0, 0}; t[key] = s end
+        return s
+    end
+    local function flush(now)
+        if last_time then
+            local elapsed = now - last_time
+            if last_line then
+                local s = lines[last_line]
+                s[2] = s[2] + elapsed
+            end
+            if #stack > 0 then
+                local s = funcs[stack[#stack]]
+                s[2] = s[2] + elapsed
+            end
+        end
+        last_time = now
+    end
+
+    sethook(function(event, line)
+        if done then return end
+        local now = clock()
+        if event == "line" then
+            if not started then return end
+            -- Lines of this prelude (after the script ended by an error) aren't the script's
+            local info = getinfo(2, "S")
+            if info.source == "=luaengine" then return end
+            check(1)
+            flush(now)
+            last_line = info.short_src .. ":" .. line
+            local s = stat(lines, last_line)
+            s[1] = s[1] + 1
+        elseif event == "call" or event == "tail call" then
+            local info = getinfo(2, "Snf")
+            if not started then
+                if info.func ~= chunk then return end
+                started = true
+            end
+            flush(now)
+            -- A tail call replaces the running frame instead of nesting in it
+            if event == "tail call" then stack[#stack] = nil end
+            local key = info.short_src .. ":" .. info.linedefined .. " " ..
+                (info.name or (info.what == "main" and "main chunk" or "?"))
+            local s = stat(funcs, key)
+            s[1] = s[1] + 1
+            stack[#stack + 1] = key
+        elseif started then
+            flush(now)
+            stack[#stack] = nil
+            if #stack == 0 then done = true end
+        end
+    end, "crl")
+    local results = pack(pcall(chunk))
+    sethook()
+    flush(clock())
+    results[results.n + 1], results[results.n + 2], results.n = lines, funcs, results.n + 2
+    return finish(results, tripped)
+end
+
+local function clean()
+    collectgarbage()
+    if getmetatable("") ~= string_meta then return false end
+    for t, saved in next, shared do
+        local members, meta = saved[1], saved[2]
+        if getmetatable(t) ~= meta then return false end
+        for key, value in next, t do
+            if members[key] ~= value then return false end
+        end
+        for key in next, members do
+            if rawget(t, key) == nil then return false end
+        end
+    end
+    return true
+end
+
+return compile, run, profile, clean, memory_api
+'''.replace(b'HOOK_EVERY', b'%d' % HOOK_EVERY).replace(b'BRIDGE_CHUNK', b'%d' % BRIDGE_CHUNK).replace(b'LIMIT_PREFIX', LIMIT_PREFIX.encode())
+
+
+def lua_text(value):
+    """Python value for something a bytes-mode runtime returned (bytes become str)."""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, tuple):
+        return tuple(lua_text(v) for v in value)
+    return value
+
+
+def lua_error_text(error):
+    """Message of a LuaError; lupa decodes it as latin-1 when the runtime has no encoding."""
+    return str(error).encode('latin-1', 'replace').decode('utf-8', 'replace')
+
+
+class ScriptAborted(Exception):
+    """A script hit its instruction, time or memory limit and was stopped."""
+
+
+def _limit_error(error, max_memory):
+    """ScriptAborted for a LuaError raised by a limit, None for an ordinary script error."""
+    if isinstance(error, LuaMemoryError):
+        return ScriptAborted(f"memory limit of {max_memory / 1024 / 1024:.0f} MB reached")
+    text = lua_error_text(error)
+    if text.startswith(LIMIT_PREFIX):
+        return ScriptAborted(text[len(LIMIT_PREFIX):].splitlines()[0])
+    return None
+
+
+class ChunkCache:
+    """Compiled Lua chunks (string.dump bytecode) keyed by the sha256 of their source.
+
+    Bytecode is runtime independent, so a chunk compiled once is reused by
+    every runtime in the pool. Editing a script changes its hash; invalidate()
+    also drops the old entry so stale bytecode doesn't pile up.
+    """
+
+    def __init__(self):
+        self._chunks = {}
+        self._by_name = {}
+        self._lock = threading.Lock()
+
+    def get(self, runtime, name, source):
+        key = hashlib.sha256(source).digest()
+        with self._lock:
+            bytecode = self._chunks.get(key)
+        if bytecode is None:
+            metrics.count('lua compiles')
+            bytecode = runtime.compile(source, b'=' + name.encode())
+            with self._lock:
+                self._chunks[key] = bytecode
+                old = self._by_name.get(name)
+                self._by_name[name] = key
+                if old is not None and old != key:
+                    self._chunks.pop(old, None)
+        return bytecode
+
+    def invalidate(self, name):
+        with self._lock:
+            key = self._by_name.pop(name, None)
+            if key is not None:
+                self._chunks.pop(key, None)
+
+    def __len__(self):
+        return len(self._chunks)
+
+
+class _Runtime:
+    """A LuaRuntime with the prelude loaded, capped at max_memory bytes."""
+
+    def __init__(self, max_memory=None):
+        # No encoding: Lua strings come back as bytes, which bytecode needs
+        self.lua = LuaRuntime(unpack_returned_tuples=True, encoding=None, max_memory=max_memory)
+        load = self.lua.eval('load')
+        self.compile, self.run, self.profile, self.clean, self.memory_api = load(_PRELUDE, b'=luaengine')()
+
+    def bridge(self, memory, readonly=False):
+        """The `memory` table for a run, or None when there is no store."""
+        if memory is None:
+            return None
+        return self.memory_api(*MemoryBridge(memory, readonly).functions())
+
+
+class _MemberFile:
+    """Read position in one member, behind a Lua file handle."""
+
+    def __init__(self, store, name):
+        self._store = store
+        self._name = name
+        self._pos = 0
+        self._file = store.open(name)
+
+    def read(self, size):
+        data = self._file.read(max(int(size), 0))
+        self._pos += len(data)
+        # Like Lua, reading a number of bytes at the end gives nil
+        return data if data or not size else None
+
+    def readline(self, keep_end):
+        line = self._file.readline()
+        if not line:
+            return None
+        self._pos += len(line)
+        return line if keep_end else _chomp(line)
+
+    def readall(self):
+        data = self._file.read()
+        self._pos += len(data)
+        return data
+
+    def seek(self, whence, offset):
+        base = {b'set': 0, b'cur': self._pos, b'end': self._store.size(self._name)}[whence]
+        pos = max(base + int(offset), 0)
+        if pos != self._pos:
+            self._file.close()
+            self._file = self._store.open(self._name, pos)
+            self._pos = pos
+        return pos
+
+    def close(self):
+        self._file.close()
+
+
+def _chomp(line):
+    """line without its line ending, like Lua's "l" read format (but \r\n too)."""
+    if line.endswith(b'\n'):
+        line = line[:-1]
+        if line.endswith(b'\r'):
+            line = line[:-1]
+    return line
+
+
+def _next_of(iterator):
+    """A function giving the next item of iterator, then None: a Lua for-in iterator."""
+    return lambda *args: next(iterator, None)
+
+
+class MemoryBridge:
+    """The Python half of the `memory` table scripts see, backed by a MemoryStore.
+
+    Names and data cross as Lua strings (bytes). Nothing hands Lua a whole
+    member unless the script asks for it with memory.read(name): lines,
+    chunks and handles read the member piece by piece, so a script's memory
+    use stays bounded however big the file is.
+    """
+
+    def __init__(self, store, readonly=False):
+        self.store = store
+        self.readonly = readonly
+
+    def functions(self):
+        return (self.exists, self.size, self.names, self.read, self.lines, self.chunks,
+                self.open, None if self.readonly else self.write)
+
+    def exists(self, name):
+        return name.decode('utf-8', 'replace') in self.store
+
+    def size(self, name):
+        return self.store.size(name.decode('utf-8', 'replace'))
+
+    def names(self):
+        return _next_of(name.encode('utf-8') for name in self.store.names())
+
+    def read(self, name, offset, length):
+        offset = max(int(offset), 0)
+        end = None if length is None else offset + max(int(length), 0)
+        # Stored chunks are mmap views valid only until the next one, so copy each
+        return b''.join(bytes(chunk) for chunk in self.store.iter_chunks(name.decode('utf-8', 'replace'), offset, end))
+
+    def lines(self, name):
+        """Pieces of name that end at line feeds (but the last); Lua splits them into lines."""
+        return _next_of(self._line_blocks(name.decode('utf-8', 'replace')))
+
+    def _line_blocks(self, name):
+        pending = b''
+        for chunk in self.store.iter_chunks(name, chunk_size=BRIDGE_CHUNK):
+            pending += chunk
+            cut = pending.rfind(b'\n') + 1
+            if cut:
+                yield pending[:cut]
+                pending = pending[cut:]
+        if pending:
+            yield pending
+
+    def chunks(self, name, chunk_size):
+        chunks = self.store.iter_chunks(name.decode('utf-8', 'replace'), chunk_size=max(int(chunk_size), 1))
+        return _next_of(bytes(chunk) for chunk in chunks)
+
+    def open(self, name):
+        member = _MemberFile(self.store, name.decode('utf-8', 'replace'))
+        return member.read, member.readline, member.readall, member.seek, member.close
+
+    def write(self, name, data):
+        self.store.write(name.decode('utf-8', 'replace'), data)
+
+
+class LuaEngine:
+    """Runs stored Lua scripts on warm, pooled runtimes with cached bytecode.
+
+    A repeated run of an unchanged script skips both compiling and runtime
+    start-up: the bytecode comes from the cache and the runtime from the pool.
+
+    Every run is bounded by max_instructions and max_memory (None for no
+    limit); a script that hits one raises ScriptAborted instead of hanging.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, max_instructions=MAX_INSTRUCTIONS, max_memory=MAX_MEMORY):
+        self.pool_size = pool_size
+        self.max_instructions = max_instructions
+        self.max_memory = max_memory
+        self.chunks = ChunkCache()
+        self._pool = queue.LifoQueue()  # Most recently used (warmest) first
+
+    def set_limits(self, max_instructions, max_memory):
+        self.max_instructions = max_instructions
+        if max_memory != self.max_memory:
+            self.max_memory = max_memory
+            # The memory cap is fixed when a runtime is created
+            while not self._pool.empty():
+                self._pool.get_nowait()
+
+    def warm(self):
+        """Fill the pool with ready runtimes."""
+        while self._pool.qsize() < self.pool_size:
+            self._pool.put(_Runtime(self.max_memory))
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            metrics.count('lua runtimes started')
+            return _Runtime(self.max_memory)
+
+    def _release(self, runtime):
+        if self._pool.qsize() < self.pool_size and runtime.clean():
+            self._pool.put(runtime)
+
+    def run(self, name, source, memory=None, out=None):
+        """Run a script and return what it returned.
+
+        With a MemoryStore the script gets a `memory` table to read and
+        write it. With an out list, what the script prints is appended to
+        it instead of going to the console. Lua errors raise LuaError,
+        hitting a limit raises ScriptAborted.
+        """
+        if isinstance(source, str):
+            source = source.encode('utf-8')
+        start = time.perf_counter()
+        runtime = self._acquire()
+        captured = runtime.lua.table() if out is not None else None
+        try:
+            bytecode = self.chunks.get(runtime, name, source)
+            return lua_text(runtime.run(bytecode, b'=' + name.encode(), captured, runtime.bridge(memory),
+                                        None, self.max_instructions))
+        except LuaError as e:
+            raise _limit_error(e, self.max_memory) or e
+        finally:
+            if captured is not None:
+                out.extend(lua_text(captured[i]) for i in range(1, len(captured) + 1))
+            self._release(runtime)
+            metrics.observe('lua run', time.perf_counter() - start)
+
+    def profile(self, name, source, memory=None, out=None):
+        """Run a script under the profiler. Returns (result, lines, functions).
+
+        lines and functions are lists of (where, hits, self seconds), slowest
+        first. The instruction limit counts executed lines here. out works
+        as for run().
+        """
+        if isinstance(source, str):
+            source = source.encode('utf-8')
+        runtime = self._acquire()
+        captured = runtime.lua.table() if out is not None else None
+        try:
+            bytecode = self.chunks.get(runtime, name, source)
+            *result, lines, funcs = runtime.profile(bytecode, b'=' + name.encode(), captured, runtime.bridge(memory),
+                                                    PROFILE_TIMEOUT, self.max_instructions)
+        except LuaError as e:
+            raise _limit_error(e, self.max_memory) or e
+        finally:
+            if captured is not None:
+                out.extend(lua_text(captured[i]) for i in range(1, len(captured) + 1))
+            self._release(runtime)
+        result = lua_text(tuple(result)) if len(result) != 1 else lua_text(result[0])
+        return result or None, _hotspots(lines), _hotspots(funcs)
+
+    def invalidate(self, name):
+        """Forget the compiled chunk of a script that was changed or removed."""
+        self.chunks.invalidate(name)
+
+
+def _hotspots(stats):
+    rows = [(lua_text(where), stat[1], stat[2]) for where, stat in stats.items()]
+    return sorted(rows, key=lambda row: (-row[2], -row[1]))
+
+
+# Shared by the programmer for the whole session
+ENGINE = LuaEngine()
+
+
+BatchResult = collections.namedtuple('BatchResult', 'name ok result error output wall cpu')
+
+# One runtime, chunk cache and store per batch worker process
+_worker_runtime = None
+_worker_chunks = None
+_worker_memory = None
+_worker_config = (None, None, None, None)
+
+
+def _init_worker(max_instructions=None, max_memory=None, memory_path=None, started=None):
+    global _worker_runtime, _worker_chunks, _worker_memory, _worker_config
+    _worker_config = (max_instructions, max_memory, memory_path, started)
+    _worker_runtime = _Runtime(max_memory)
+    _worker_chunks = ChunkCache()
+    # Compacting is left to the main process: the pool may terminate a worker at any time
+    _worker_memory = MemoryStore(memory_path, compact_threshold=float('inf')) if memory_path else None
+
+
+def _run_job(index, name, source, timeout):
+    """Run one script in a batch worker, capturing its output."""
+    max_instructions, max_memory, _, started = _worker_config
+    if started is not None:
+        # run_batch times each script from here, not from when it was queued
+        started.put((index, time.monotonic()))
+    out = _worker_runtime.lua.table()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        bytecode = _worker_chunks.get(_worker_runtime, name, source)
+        # Writes take the archive's cross-process write lock like any other SussyOS process
+        api = _worker_runtime.bridge(_worker_memory)
+        result = lua_text(_worker_runtime.run(bytecode, b'=' + name.encode(), out, api, timeout, max_instructions))
+        ok, error = True, None
+    except LuaError as e:
+        aborted = _limit_error(e, max_memory)
+        result, ok, error = None, False, f"aborted: {aborted}" if aborted else lua_error_text(e)
+    except Exception as e:
+        # A Python error out of a bridge call fails this script, not the whole batch
+        result, ok, error = None, False, f"{type(e).__name__}: {e}"
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    output = ''.join(lua_text(out[i]) for i in range(1, len(out) + 1))
+    if not _worker_runtime.clean():
+        _init_worker(*_worker_config)
+    return BatchResult(name, ok, None if result is None else str(result), error, output, wall, cpu)
+
+
+def run_batch(scripts, workers=None, timeout=BATCH_TIMEOUT, engine=ENGINE, memory_path=None):
+    """Run (name, source) scripts across a process pool. Returns BatchResults in input order.
+
+    Every worker process has its own runtime. Each script gets timeout
+    seconds of CPU, plus the engine's instruction and memory limits, and
+    its print/io.write output is captured, so parallel runs never
+    interleave on the console. With memory_path every worker opens that
+    archive itself and scripts get a `memory` table on it; their writes
+    are committed under the archive's write lock, so they never clash.
+
+    A script whose worker is still busy timeout + HUNG_GRACE seconds after
+    picking it up is given up on as hung. Once every worker is stuck like
+    that, the scripts that never started are reported as not run.
+    """
+    scripts = [(name, source.encode('utf-8') if isinstance(source, str) else source)
+               for name, source in scripts]
+    workers = workers or os.cpu_count() or 1
+    results = [None] * len(scripts)
+    started = {}  # Script index -> time.monotonic() its worker picked it up
+    stuck = 0  # Workers busy with a script given up on as hung
+    reports = multiprocessing.Queue()
+    config = (engine.max_instructions, engine.max_memory, memory_path, reports)
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=config) as pool:
+        pending = {index: pool.apply_async(_run_job, (index, name, source, timeout))
+                   for index, (name, source) in enumerate(scripts)}
+        while pending:
+            try:
+                index, when = reports.get(timeout=BATCH_POLL)
+                started[index] = when
+                while True:
+                    index, when = reports.get_nowait()
+                    started[index] = when
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            for index, job in list(pending.items()):
+                if job.ready():
+                    results[index] = job.get()
+                elif index in started and now - started[index] > timeout + HUNG_GRACE:
+                    results[index] = BatchResult(scripts[index][0], False, None, "timeout: worker stopped responding",
+                                                 '', now - started[index], None)
+                    stuck += 1
+                else:
+                    continue
+                del pending[index]
+            if pending and stuck >= workers:
+                for index in pending:
+                    results[index] = BatchResult(scripts[index][0], False, None,
+                                                 "not run: every worker was stuck on a hung script", '', 0.0, None)
+                break
+    # Leaving the with block terminates the pool, hung workers included
+    reports.close()
+    return results
@@ -1,60 +1,126 @@
-import browse
-import filemanager
-import programmer
+import time
+BOOT_START = time.perf_counter()
+import importlib
 import socket
+import sys
+import threading
 from pathlib import Path
+import compresspolicy
+import metrics
+from commands import APPS
+from memorystore import MemoryStore, recover
 
-print("Booting Up SussyOS...")
+# The apps (and requests, bs4, lupa, winreg behind them) are only imported
+# when their command is first used, see app()
+
+PROBE_HOST = ("www.google.com", 80)
+PROBE_TIMEOUT = 2  # seconds
+
+# --boot-profile prints how long each part of the boot took
+boot_profile = '--boot-profile' in sys.argv
+phases = [("imports", time.perf_counter())]
 
 def check_internet():
     try:
         # Connect to the host -- tells us if the host is actually reachable
-        socket.create_connection(("www.google.com", 80))
+        socket.create_connection(PROBE_HOST, timeout=PROBE_TIMEOUT).close()
         return True
     except OSError:
         return False
 
-if check_internet():
-    print("Succesfully Connected to the Internet!")
-else:
-    print("Warning! No Internet Connection, browser wouldn't work!")
-    
-my_file = Path("memory.zip")
-if my_file.is_file():
-    print("Memory founded...")
-else:
-    print("Warning! No memory found, it will be created dynamicly...")
-    
-my_file = Path("filemanager.py")
-if my_file.is_file():
-    print("File Manager is founded...")
-else:
-    print("ERROR: No File Manager is founded!")
-
-my_file = Path("browse.py")
-if my_file.is_file():
-    print("Browser is founded...")
-else:
-    print("ERROR: No Browser is founded!")
-my_file = Path("programmer.py")
-if my_file.is_file():
-    print("Programmer is founded...")
-else:
-    print("ERROR: No Programmer is founded!")
-    
-print("Booted Succesfully! :)")
-
-print("\n")
-print("-----------------------------------------------------------------")
-print("#######  #     #  #######  #######  #     #      #######  #######")
-print("#        #     #  #        #         #    #      #     #  #")
-print("#######  #     #  #######  #######    #####      #     #  #######")
-print("      #  #     #        #        #        #      #     #        #")
-print("#######  #######  #######  #######  ######       #######  #######")
-print("-----------------------------------------------------------------")
-print("\n")
-
-def main():
+# Checked in the background so an offline boot doesn't wait for it
+internet = []
+probe = threading.Thread(target=lambda: internet.append(check_internet()), daemon=True)
+
+def report_internet(wait):
+    """Print the result of the probe once, waiting up to wait seconds for it."""
+    probe.join(wait)
+    if not internet or internet[0] is None:
+        return
+    if internet[0]:
+        print("Succesfully Connected to the Internet!")
+    else:
+        print("Warning! No Internet Connection, browser wouldn't work!")
+    internet[0] = None  # Reported
+
+_apps = {}
+
+def app(command):
+    """The app module behind command, imported the first time it is asked for."""
+    module = APPS[command]
+    if module not in _apps:
+        start = time.perf_counter()
+        _apps[module] = importlib.import_module(module)
+        if boot_profile:
+            print(f"[boot profile] {module} imported in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return _apps[module]
+
+def boot():
+    """Print the boot messages and open the memory session shared by every app."""
+    print("Booting Up SussyOS...")
+    probe.start()
+    phases.append(("internet probe started", time.perf_counter()))
+
+    # Finishes off (rolls back) a write that a crash or power cut interrupted
+    status = recover()
+    if status == 'recovered':
+        print("Memory founded... an unfinished write was rolled back")
+    elif status == 'damaged':
+        print("ERROR: Memory is damaged and couldn't be recovered!")
+    elif status == 'missing':
+        print("Warning! No memory found, it will be created dynamicly...")
+    else:
+        print("Memory founded...")
+    # --compress CODEC sets the default compression policy (auto, stored, deflate, bzip2, lzma)
+    compression = sys.argv[sys.argv.index('--compress') + 1] if '--compress' in sys.argv[:-1] else 'auto'
+    if compression not in compresspolicy.POLICIES:
+        print(f"Warning! Unknown compression '{compression}', using auto...")
+        compression = 'auto'
+    memory = MemoryStore(dedup='--dedup' in sys.argv, compression=compression)  # One memory session shared by every app
+    phases.append(("memory", time.perf_counter()))
+
+    my_file = Path("filemanager.py")
+    if my_file.is_file():
+        print("File Manager is founded...")
+    else:
+        print("ERROR: No File Manager is founded!")
+
+    my_file = Path("browse.py")
+    if my_file.is_file():
+        print("Browser is founded...")
+    else:
+        print("ERROR: No Browser is founded!")
+    my_file = Path("programmer.py")
+    if my_file.is_file():
+        print("Programmer is founded...")
+    else:
+        print("ERROR: No Programmer is founded!")
+    phases.append(("app check", time.perf_counter()))
+
+    report_internet(0)
+    print("Booted Succesfully! :)")
+
+    print("\n")
+    print("-----------------------------------------------------------------")
+    print("#######  #     #  #######  #######  #     #      #######  #######")
+    print("#        #     #  #        #         #    #      #     #  #")
+    print("#######  #     #  #######  #######    #####      #     #  #######")
+    print("      #  #     #        #        #        #      #     #        #")
+    print("#######  #######  #######  #######  ######       #######  #######")
+    print("-----------------------------------------------------------------")
+    print("\n")
+    phases.append(("banner", time.perf_counter()))
+
+    if boot_profile:
+        print("[boot profile]")
+        last = BOOT_START
+        for name, at in phases:
+            print(f"  {name:<24} {(at - last) * 1000:8.1f} ms")
+            last = at
+        print(f"  {'total':<24} {(last - BOOT_START) * 1000:8.1f} ms")
+    return memory
+
+def main(memory):
     while True:
         command = input("Command: ")
         if command == "help":
@@ -64,19 +130,26 @@ def main():
             print("browser - launches sussy browser")
             print("filemanager - launches file manager")
             print("programmer - lua programmer mode")
+            print("stats - latencies, bytes read and written, archive rewrites so far")
             print("exit - exit sussyos")
             print("--------------------------------")
             print("\n")
             print("REMEMBER: ONLY SMALL LETTERS IN COMMANDS!")
-        if command == "browser":
-            browse.main()
-        if command == "filemanager":
-            filemanager.main()
-        if command == "programmer":
-            programmer.main()
-        if command == "exit":
+        elif command == "browser":
+            report_internet(PROBE_TIMEOUT)
+            app(command).main(memory)
+        elif command == "filemanager":
+            app(command).main(memory)
+        elif command == "programmer":
+            app(command).main(memory)
+        elif command == "stats":
+            for line in metrics.report():
+                print(line)
+        elif command == "exit":
             break
         else:
             print("Wrong command! use 'help' for list of commands")
-        
-main()
\ No newline at end of file
+
+# Guarded: runall's worker processes import this module again when they are spawned (always on Windows)
+if __name__ == '__main__':
+    main(boot())
@@ -0,0 +1,922 @@
+import bz2
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import io
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+import compresspolicy
+import dedup
+import metrics
+
+try:
+    import msvcrt
+except ImportError:  # Not Windows
+    msvcrt = None
+    import fcntl
+
+# Memory storage file (the zip file)
+MEMORY_FILE = "memory.zip"
+
+# Compact once dead (tombstoned) bytes are this share of the archive data...
+COMPACT_THRESHOLD = 0.5
+# ...and there are at least this many of them, so small archives are left alone
+COMPACT_MIN_BYTES = 1024 * 1024
+
+COPY_BUFFER = 1024 * 1024
+
+# Bulk imports compress files up to this size in the worker pool; bigger
+# ones are streamed by the writer so a worker never holds them in memory
+BULK_INMEMORY_LIMIT = 64 * 1024 * 1024
+# ...and stop reading ahead once the files in flight add up to this much
+BULK_WINDOW_BYTES = 256 * 1024 * 1024
+
+# Field positions in a local file header (see zipfile.structFileHeader)
+_FH_FLAG_BITS = 3
+_FH_FILENAME_LENGTH = 10
+_FH_EXTRA_FIELD_LENGTH = 11
+
+# Writers hold an OS lock on this file next to the archive, so two SussyOS
+# processes never change memory.zip at the same time
+LOCK_SUFFIX = ".lock"
+LOCK_POLL = 0.05
+# A reader that finds memory.zip replaced under it (compacted or wiped) tries
+# again with a fresh index this many times, LOCK_POLL apart
+LOCATE_ATTEMPTS = 100
+# While a commit runs, the central directory it overwrites is saved here;
+# if the commit never finishes, recover() puts it back
+JOURNAL_SUFFIX = ".journal"
+
+# One write lock per archive path, shared by every MemoryStore in the process
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+class _ArchiveLock:
+    """Write lock of one archive: a thread RLock plus an OS lock on the .lock file.
+
+    Re-entrant within a thread; the OS lock is taken by the outermost
+    acquire and works across processes (flock, or msvcrt on Windows).
+    """
+
+    def __init__(self, path):
+        self.path = path + LOCK_SUFFIX
+        self._rlock = threading.RLock()
+        self._depth = 0
+        self._file = None
+        # The Transaction open under this lock, if any (only its owner thread gets here)
+        self.transaction = None
+
+    def __enter__(self):
+        self._rlock.acquire()
+        if self._depth == 0:
+            try:
+                self._lock_file()
+            except BaseException:
+                self._rlock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0:
+            self._unlock_file()
+        self._rlock.release()
+
+    def _lock_file(self):
+        f = open(self.path, 'a+b')
+        try:
+            if msvcrt:
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        time.sleep(LOCK_POLL)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            f.close()
+            raise
+        self._file = f
+
+    def _unlock_file(self):
+        f, self._file = self._file, None
+        try:
+            if msvcrt:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        finally:
+            f.close()
+
+
+def _lock_for(path):
+    with _locks_guard:
+        return _locks.setdefault(os.path.abspath(path), _ArchiveLock(path))
+
+
+def _fsync(path):
+    with open(path, 'r+b') as f:
+        os.fsync(f.fileno())
+
+
+def _write_journal(path, start_dir):
+    """Save everything from start_dir on (the central directory a commit will overwrite)."""
+    journal = path + JOURNAL_SUFFIX
+    with open(path, 'rb') as src, open(journal + '.tmp', 'wb') as dst:
+        dst.write(struct.pack('<Q', start_dir))
+        _copy_range(src, dst, start_dir, os.path.getsize(path) - start_dir)
+        dst.flush()
+        os.fsync(dst.fileno())
+    # Only a complete journal is ever under the real name
+    os.replace(journal + '.tmp', journal)
+
+
+def _roll_back(path):
+    """Put the archive back the way it was before the journaled commit started."""
+    journal = path + JOURNAL_SUFFIX
+    with open(journal, 'rb') as src, open(path, 'r+b') as dst:
+        start_dir, = struct.unpack('<Q', src.read(8))
+        dst.truncate(start_dir)
+        dst.seek(start_dir)
+        for block in iter(lambda: src.read(COPY_BUFFER), b''):
+            dst.write(block)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.remove(journal)
+
+
+def recover(path=MEMORY_FILE):
+    """Bring an archive back to a consistent state after a crash. Run at boot.
+
+    Waits for any writer still at work, rolls back a commit that was cut
+    off and clears temporary files. Returns 'ok', 'recovered' (a commit
+    was rolled back), 'missing' (no archive yet) or 'damaged' (it doesn't
+    open as a zip and there was nothing to roll back).
+    """
+    with _lock_for(path):
+        for leftover in (path + '.compact', path + '.wipe', path + JOURNAL_SUFFIX + '.tmp'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        if not os.path.exists(path):
+            return 'missing'
+        status = 'ok'
+        if os.path.exists(path + JOURNAL_SUFFIX):
+            _roll_back(path)
+            status = 'recovered'
+        try:
+            with zipfile.ZipFile(path, 'r'):
+                pass
+        except zipfile.BadZipFile:
+            return 'damaged'
+        return status
+
+
+def member_span(info):
+    """Bytes a member takes up in the archive (local header + data), as far as the central directory tells."""
+    return zipfile.sizeFileHeader + len(info.filename.encode('utf-8')) + len(info.extra) + info.compress_size
+
+
+def _raw_member_length(fp, info):
+    """Exact length of a member's local header, data and data descriptor."""
+    fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+    length = (zipfile.sizeFileHeader + header[_FH_FILENAME_LENGTH]
+              + header[_FH_EXTRA_FIELD_LENGTH] + info.compress_size)
+    if header[_FH_FLAG_BITS] & 0x08:
+        # Data descriptor follows the data, with or without its signature
+        fp.seek(info.header_offset + length)
+        length += 16 if fp.read(4) == b'PK\x07\x08' else 12
+    return length
+
+
+def _data_offset(fp, info):
+    """Archive offset where a member's (possibly compressed) data starts."""
+    fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+    return fp.tell() + header[_FH_FILENAME_LENGTH] + header[_FH_EXTRA_FIELD_LENGTH]
+
+
+def _copy_range(src, dst, offset, length):
+    src.seek(offset)
+    while length:
+        chunk = src.read(min(length, COPY_BUFFER))
+        if not chunk:
+            raise zipfile.BadZipFile("Truncated member data")
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+def _compressor(compress_type, level=None):
+    if compress_type == zipfile.ZIP_DEFLATED:
+        return zlib.compressobj(-1 if level is None else level, zlib.DEFLATED, -15)
+    if compress_type == zipfile.ZIP_BZIP2:
+        return bz2.BZ2Compressor(level or 9)
+    if compress_type == zipfile.ZIP_LZMA:
+        return zipfile.LZMACompressor()
+    return None
+
+
+def prepare_member(file_path, name, compression='auto'):
+    """Read and compress one file ahead of writing it (safe to run in a worker thread).
+
+    The codec comes from the compression policy (see compresspolicy.choose).
+
+    Returns (ZipInfo, compressed data) ready for Transaction.write_prepared,
+    or None when the file is too big to hold in memory.
+    """
+    info = zipfile.ZipInfo.from_file(file_path, name)
+    if info.file_size > BULK_INMEMORY_LIMIT:
+        return None
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    compress_type, level = compresspolicy.choose(name, data, policy=compression)
+    info.compress_type = compress_type
+    info.file_size = len(data)
+    info.CRC = zlib.crc32(data)
+    compressor = _compressor(compress_type, level)
+    payload = compressor.compress(data) + compressor.flush() if compressor else data
+    info.compress_size = len(payload)
+    if compress_type == zipfile.ZIP_LZMA:
+        info.flag_bits |= 0x02  # The LZMA stream ends with an end-of-stream marker
+    return info, payload
+
+
+class _ChunkReader(io.RawIOBase):
+    """Raw stream over an iterator of chunks, so chained blobs read like one file."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            try:
+                self._pending = bytes(next(self._chunks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def close(self):
+        self._chunks.close()
+        super().close()
+
+
+class _IndexedZipFile(zipfile.ZipFile):
+    """ZipFile opened for appending that takes its central directory from a MemoryStore's index.
+
+    Opening with mode 'a' otherwise reads and parses the whole directory,
+    on every commit. Only for an index loaded from the file as it is now,
+    under the write lock.
+    """
+
+    def __init__(self, path, index, start_dir, comment):
+        self._cached = index, start_dir, comment
+        super().__init__(path, 'a')
+
+    def _RealGetContents(self):
+        index, self.start_dir, self._comment = self._cached
+        self.NameToInfo = dict(index)
+        self.filelist = list(index.values())
+
+
+class Transaction:
+    """A batch of changes to memory.zip, committed with one central directory write.
+
+    New versions are appended after the existing data. Removed or replaced
+    members are only dropped from the central directory (tombstoned); their
+    bytes stay behind as dead space until the archive is compacted.
+
+    With dedup on, payloads are stored once as content-addressed blobs and
+    the named member only lists the blobs it is made of.
+
+    compression is the policy used when a write doesn't name its own (see
+    compresspolicy.choose).
+    """
+
+    def __init__(self, zipf, dedup=False, compression='auto'):
+        self.zipf = zipf
+        self.dedup = dedup
+        self.compression = compression
+        self._digests = None
+        self.first_offset = zipf.start_dir  # Where this transaction starts writing
+        self.changed = set()  # Names written or removed, for MemoryStore.listeners
+
+    def __contains__(self, name):
+        return name in self.zipf.NameToInfo
+
+    def namelist(self):
+        return [name for name in self.zipf.NameToInfo if not name.startswith(dedup.RESERVED_PREFIX)]
+
+    def remove(self, name):
+        """Tombstone a member. Returns False if there was nothing to remove."""
+        # Every write removes its name first, so this sees writes too
+        self.changed.add(name)
+        info = self.zipf.NameToInfo.pop(name, None)
+        if info is None:
+            return False
+        self.zipf.filelist.remove(info)
+        self.zipf._didModify = True
+        return True
+
+    def write(self, name, data, compression=None):
+        """Store data under name, replacing any previous version."""
+        compression = compression or self.compression
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self.dedup:
+            self._write_deduped(name, io.BytesIO(data), compression)
+            return
+        self.remove(name)
+        compress_type, level = compresspolicy.choose(name, data, policy=compression)
+        self.zipf.writestr(name, data, compress_type, level)
+
+    def write_file(self, file_path, name=None, compression=None):
+        """Store a file from disk, by default under its base name."""
+        name = name or os.path.basename(file_path)
+        compression = compression or self.compression
+        if self.dedup:
+            with open(file_path, 'rb') as f:
+                self._write_deduped(name, f, compression)
+            return
+        self.remove(name)
+        compress_type, level = compresspolicy.choose(
+            name, compresspolicy.read_sample(file_path), os.path.getsize(file_path), compression)
+        self.zipf.write(file_path, name, compress_type, level)
+
+    def write_stream(self, name, chunks, size=None, compression=None):
+        """Store the bytes of an iterable of chunks (a response body, say) as they arrive.
+
+        The data goes straight into the member through ZipFile.open(name,
+        'w'); nothing is buffered beyond the first chunks the compression
+        policy samples. size, if known, only helps that choice. If the
+        stream fails midway the partial member is dropped and any previous
+        version stays. Returns the number of bytes stored.
+        """
+        compression = compression or self.compression
+        chunks = iter(chunks)
+        if self.dedup:
+            # Dedup reads the payload twice, so it needs a seekable copy
+            with tempfile.SpooledTemporaryFile(BULK_INMEMORY_LIMIT) as spool:
+                for chunk in chunks:
+                    spool.write(chunk)
+                written = spool.tell()
+                spool.seek(0)
+                self._write_deduped(name, spool, compression)
+            return written
+        sample = b''
+        for chunk in chunks:
+            sample += chunk
+            if len(sample) >= compresspolicy.SAMPLE_SIZE:
+                break
+        compress_type, level = compresspolicy.choose(name, sample, size, compression)
+        old = self.zipf.NameToInfo.get(name)
+        self.remove(name)
+        info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        info.compress_type = compress_type
+        info._compresslevel = level
+        info.file_size = size or 0
+        written = len(sample)
+        try:
+            with self.zipf.open(info, 'w') as dst:
+                dst.write(sample)
+                for chunk in chunks:
+                    dst.write(chunk)
+                    written += len(chunk)
+        except BaseException:
+            self.remove(name)
+            if old is not None:
+                self.zipf.filelist.append(old)
+                self.zipf.NameToInfo[name] = old
+            raise
+        return written
+
+    def write_prepared(self, info, payload):
+        """Append a member whose data was compressed beforehand (see prepare_member)."""
+        self.remove(info.filename)
+        zipf = self.zipf
+        zipf.fp.seek(zipf.start_dir)
+        info.header_offset = zipf.start_dir
+        zipf.fp.write(info.FileHeader())
+        zipf.fp.write(payload)
+        zipf.start_dir = zipf.fp.tell()
+        zipf.filelist.append(info)
+        zipf.NameToInfo[info.filename] = info
+        zipf._didModify = True
+
+    def _pointer_for(self, digest):
+        """An existing pointer member with this content, if there is one."""
+        if self._digests is None:
+            self._digests = {dedup.parse_pointer(info)[1]: info
+                             for info in self.zipf.filelist if dedup.is_pointer(info)}
+        return self._digests.get(digest)
+
+    def _write_deduped(self, name, fileobj, compression):
+        size, digest = dedup.file_digest(fileobj)
+        current = self.zipf.NameToInfo.get(name)
+        if current is not None and dedup.is_pointer(current) and dedup.parse_pointer(current) == (size, digest):
+            return  # Same content under the same name: nothing to write at all
+        same = self._pointer_for(digest)
+        if same is not None:
+            blobs = self.zipf.read(same)
+        else:
+            fileobj.seek(0)
+            names = []
+            for chunk in dedup.split(fileobj):
+                blob = dedup.blob_name(chunk)
+                if blob not in self.zipf.NameToInfo:
+                    compress_type, level = compresspolicy.choose(name, chunk, policy=compression)
+                    self.zipf.writestr(blob, chunk, compress_type, level)
+                names.append(blob)
+            blobs = '\n'.join(names).encode()
+        self.remove(name)
+        info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        info.comment = dedup.pointer_comment(size, digest)
+        self.zipf.writestr(info, blobs)
+        self._digests[digest] = info
+
+
+class MemoryStore:
+    """Storage engine and session for memory.zip.
+
+    One store is created at boot and shared by every app. It keeps the
+    central directory in memory (name -> ZipInfo with offset, sizes and CRC)
+    and only re-reads it when the file's mtime or size changes, so lookups
+    by name are O(1) and listing never re-parses the archive.
+
+    Writes append, deletes tombstone, and the archive is compacted in the
+    background once dead space passes compact_threshold (or on demand with
+    compact()). compression is the default policy for picking each
+    member's codec, 'auto' or a codec name from compresspolicy.CODECS.
+
+    Writers take the archive's write lock, which other SussyOS processes
+    honour too, and every commit is journaled so it either completes or is
+    rolled back. Readers never take it: they work from the last good
+    snapshot of the index, whose member data an append never touches.
+
+    listeners are called as listener(names, stamps) after every commit
+    from this store, with the set of member names it wrote or removed and
+    the archive's stamp() just before and just after the commit (both None
+    after a wipe, when everything changed).
+    """
+
+    def __init__(self, path=MEMORY_FILE, compact_threshold=COMPACT_THRESHOLD, dedup=False, compression='auto'):
+        self.path = path
+        self.compact_threshold = compact_threshold
+        self.dedup = dedup
+        self.compression = compression
+        self._lock = _lock_for(path)
+        # Guards swapping in a new index against readers opening the archive
+        self._index_lock = threading.RLock()
+        self._compactor = None
+        self.listeners = []
+        self._index = {}
+        self._stamp = None
+        self._file_id = None  # (st_dev, st_ino) of the file the index came from
+        self._start_dir = 0
+        self._comment = b''
+        if not os.path.exists(path):
+            with self._lock:
+                if not os.path.exists(path):
+                    self._replace_with_empty()
+
+    def _load(self, zipf, st=None):
+        """Take zipf's central directory as the new snapshot; st is the stat it was read at."""
+        st = st or os.stat(self.path)
+        with self._index_lock:
+            self._index = {info.filename: info for info in zipf.filelist}
+            self._start_dir = zipf.start_dir
+            self._comment = zipf.comment
+            self._stamp = (st.st_mtime_ns, st.st_size)
+            self._file_id = (st.st_dev, st.st_ino)
+
+    def refresh(self):
+        """Re-read the central directory if memory.zip changed on disk since it was cached.
+
+        Never waits for a writer: while a commit is in flight (its journal
+        exists) or the directory doesn't parse, the last snapshot is kept.
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        if (st.st_mtime_ns, st.st_size) == self._stamp or os.path.exists(self.path + JOURNAL_SUFFIX):
+            return
+        try:
+            with zipfile.ZipFile(self.path, 'r') as zipf:
+                self._load(zipf, st)
+        except (zipfile.BadZipFile, OSError):
+            pass
+
+    def stamp(self):
+        """(mtime_ns, size) of memory.zip as last loaded; differs after any commit, from any process."""
+        self.refresh()
+        return self._stamp
+
+    def names(self):
+        self.refresh()
+        return [name for name in self._index if not name.startswith(dedup.RESERVED_PREFIX)]
+
+    def __contains__(self, name):
+        self.refresh()
+        return name in self._index
+
+    def getinfo(self, name):
+        """ZipInfo for name, raises KeyError like ZipFile.getinfo."""
+        self.refresh()
+        return self._index[name]
+
+    def size(self, name):
+        """Size of name's content (for a deduplicated member, of the data it points to)."""
+        info = self.getinfo(name)
+        return dedup.parse_pointer(info)[0] if dedup.is_pointer(info) else info.file_size
+
+    def listing(self):
+        """(name, size, size in the archive, codec) for every member."""
+        rows = []
+        for name in self.names():
+            segments = self._segments(name)
+            codecs_used = {compresspolicy.CODEC_NAMES.get(info.compress_type, '?') for info in segments}
+            rows.append((name, self.size(name), sum(info.compress_size for info in segments),
+                         '+'.join(sorted(codecs_used)) or 'stored'))
+        return rows
+
+    def _segments(self, name, fp=None):
+        """ZipInfos whose data, one after another, make up name.
+
+        A pointer's list of blobs is read from fp, the archive as _locate
+        opened it; without fp, name is located first.
+        """
+        index = self._index
+        info = index[name]
+        if not dedup.is_pointer(info):
+            return [info]
+        if fp is None:
+            fp, segments = self._locate(name)
+            fp.close()
+            return segments
+        fp.seek(_data_offset(fp, info))
+        with zipfile.ZipExtFile(fp, 'r', info) as f:
+            blobs = f.read().decode().split()
+        return [index[blob] for blob in blobs]
+
+    def _locate(self, name):
+        """Open the archive together with name's segments, consistent with each other.
+
+        If another process compacted or wiped memory.zip since the index
+        was loaded, the file opened is not the one the index describes;
+        then it is opened again once the index has been re-read.
+        """
+        for _ in range(LOCATE_ATTEMPTS):
+            self.refresh()
+            with self._index_lock:
+                fp = open(self.path, 'rb')
+                st = os.fstat(fp.fileno())
+                if (st.st_dev, st.st_ino) == self._file_id:
+                    try:
+                        return fp, self._segments(name, fp)
+                    except BaseException:
+                        fp.close()
+                        raise
+                fp.close()
+            # The new file's directory can't be read yet (a commit to it is in flight)
+            time.sleep(LOCK_POLL)
+        raise OSError(f"{self.path} kept changing while opening {name}")
+
+    def open(self, name, start=0):
+        """File-like object reading (and decompressing) one member, from byte start on."""
+        fp, segments = self._locate(name)
+        if len(segments) == 1 and not start:
+            fp.seek(_data_offset(fp, segments[0]))
+            # Counted up front: what is opened this way is nearly always read to the end
+            metrics.count('bytes read', segments[0].file_size)
+            return zipfile.ZipExtFile(fp, 'r', segments[0], None, True)
+        fp.close()
+        return io.BufferedReader(_ChunkReader(self.iter_chunks(name, start)), COPY_BUFFER)
+
+    def read(self, name):
+        with self.open(name) as f:
+            return f.read()
+
+    @contextlib.contextmanager
+    def _mapping(self, name):
+        """mmap of the archive plus the [start, end) span of a stored member's data."""
+        fp, segments = self._locate(name)
+        with fp:
+            if len(segments) != 1 or segments[0].compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{name} is not one uncompressed member, it can't be mapped")
+            start = _data_offset(fp, segments[0])
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped, start, start + segments[0].file_size
+
+    def mappable(self, name):
+        self.refresh()
+        segments = self._segments(name)
+        return len(segments) == 1 and segments[0].compress_type == zipfile.ZIP_STORED
+
+    @contextlib.contextmanager
+    def view(self, name):
+        """memoryview over a stored (uncompressed) member, mapped straight from the archive.
+
+        Nothing is copied; slices are only valid inside the with block.
+        """
+        with self._mapping(name) as (mapped, start, end):
+            with memoryview(mapped) as data, data[start:end] as member:
+                yield member
+
+    def iter_chunks(self, name, start=0, end=None, chunk_size=COPY_BUFFER):
+        """Yield the bytes of name (or of [start, end)) chunk by chunk.
+
+        Stored data comes out as mmap slices without copying, each valid
+        until the next one is requested; compressed data is decoded one
+        chunk at a time. Memory use doesn't depend on the member's size.
+        """
+        fp, segments = self._locate(name)
+        with fp, contextlib.ExitStack() as stack:
+            view = None
+            end = sum(info.file_size for info in segments) if end is None else end
+            offset = 0
+            for info in segments:
+                lo, hi = max(start - offset, 0), min(end - offset, info.file_size)
+                offset += info.file_size
+                if lo >= hi:
+                    continue
+                data_start = _data_offset(fp, info)
+                if info.compress_type == zipfile.ZIP_STORED:
+                    if view is None:
+                        mapped = stack.enter_context(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+                        view = stack.enter_context(memoryview(mapped))
+                    for pos in range(data_start + lo, data_start + hi, chunk_size):
+                        with view[pos:min(pos + chunk_size, data_start + hi)] as chunk:
+                            metrics.count('bytes read', len(chunk))
+                            yield chunk
+                    continue
+                fp.seek(data_start)
+                with zipfile.ZipExtFile(fp, 'r', info) as f:
+                    f.seek(lo)
+                    remaining = hi - lo
+                    while remaining > 0:
+                        chunk = f.read(min(chunk_size, remaining))
+                        if not chunk:
+                            break
+                        remaining -= len(chunk)
+                        metrics.count('bytes read', len(chunk))
+                        yield chunk
+
+    def iter_lines(self, name, encoding='utf-8'):
+        """Yield decoded lines of a text member (with their line endings), streaming."""
+        decoder = codecs.getincrementaldecoder(encoding)()
+        pending = ''
+        for chunk in self.iter_chunks(name):
+            pending += decoder.decode(chunk)
+            lines = pending.splitlines(keepends=True)
+            # The last piece may be a line that continues in the next chunk
+            pending = lines.pop() if lines and not lines[-1].endswith('\n') else ''
+            yield from lines
+        pending += decoder.decode(b'', final=True)
+        if pending:
+            yield pending
+
+    def tail_lines(self, name, count, encoding='utf-8'):
+        """Last count lines of a text member."""
+        if count <= 0:
+            return []
+        if not self.mappable(name):
+            return list(collections.deque(self.iter_lines(name, encoding), maxlen=count))
+        # Stored members: search back from the end of the mapping, no full scan
+        with self._mapping(name) as (mapped, start, end):
+            cut = end - 1 if end > start and mapped[end - 1] == ord('\n') else end
+            for _ in range(count):
+                cut = mapped.rfind(b'\n', start, cut)
+                if cut == -1:
+                    break
+            tail = mapped[start if cut == -1 else cut + 1:end]
+        return tail.decode(encoding).splitlines(keepends=True)
+
+    def extract(self, name, path='.'):
+        """Copy a member out to path/name. Returns the path written."""
+        target = os.path.join(path, name)
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        with open(target, 'wb') as dst:
+            for chunk in self.iter_chunks(name):
+                dst.write(chunk)
+        return target
+
+    def _open_for_append(self, st):
+        """memory.zip opened for appending, from the cached index if the file is still what was loaded.
+
+        st is the file's stat, taken under the write lock.
+        """
+        with self._index_lock:
+            if (st.st_mtime_ns, st.st_size) == self._stamp:
+                return _IndexedZipFile(self.path, self._index, self._start_dir, self._comment)
+        return zipfile.ZipFile(self.path, 'a')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Open memory.zip for changes; everything done in the block is committed together.
+
+        If the block raises, or the process dies before the commit is
+        complete, the archive goes back to how it was before the block.
+
+        Opened again on the thread that already has one open (a write from
+        inside the block, say), it hands back that same transaction, whose
+        commit then covers the nested changes too.
+        """
+        start = time.perf_counter()
+        with self._lock:
+            if self._lock.transaction is not None:
+                yield self._lock.transaction
+                return
+            if os.path.exists(self.path + JOURNAL_SUFFIX):
+                # Left by a writer that died mid-commit (we hold the lock, so none is at work)
+                _roll_back(self.path)
+                self._stamp = None
+            st = os.stat(self.path)
+            journaled = False
+            try:
+                with self._open_for_append(st) as zipf:
+                    _write_journal(self.path, zipf.start_dir)
+                    journaled = True
+                    tx = Transaction(zipf, self.dedup, self.compression)
+                    self._lock.transaction = tx
+                    try:
+                        yield tx
+                    finally:
+                        self._lock.transaction = None
+                # The new central directory is complete; make it durable, then drop the undo copy
+                _fsync(self.path)
+                os.remove(self.path + JOURNAL_SUFFIX)
+            except BaseException:
+                if journaled:
+                    _roll_back(self.path)
+                # Whatever is on disk now is re-read on the next access
+                self._stamp = None
+                raise
+            # After close start_dir is where the new central directory begins
+            self._load(zipf)
+            stamps = (st.st_mtime_ns, st.st_size), self._stamp
+            # Everything from the old central directory on was (re)written
+            metrics.count('bytes written', self._stamp[1] - tx.first_offset)
+            metrics.count('commits')
+            dead, data = self.dead_bytes(), self._start_dir
+        metrics.observe('memory commit', time.perf_counter() - start)
+        self.maybe_compact(dead, data)
+        self._notify(tx.changed, stamps)
+
+    def _notify(self, names, stamps=(None, None)):
+        for listener in self.listeners:
+            listener(names, stamps)
+
+    def write(self, name, data, compression=None):
+        with self.transaction() as tx:
+            tx.write(name, data, compression)
+
+    def write_file(self, file_path, name=None, compression=None):
+        with self.transaction() as tx:
+            tx.write_file(file_path, name, compression)
+
+    def write_many(self, files, workers=None, compression=None):
+        """Store many (file_path, name) pairs in one transaction. Returns (files, bytes) stored.
+
+        Files are read and compressed (codec picked per file by the
+        compression policy) in a thread pool, since zlib, bz2 and lzma
+        release the GIL. This thread is the single writer, appending the
+        results in order. Only a bounded window of files is in flight: at
+        most workers * 4 of them, and no more once they hold
+        BULK_WINDOW_BYTES.
+        """
+        workers = workers or os.cpu_count() or 1
+        compression = compression or self.compression
+        count = size = 0
+        with self.transaction() as tx, \
+                concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            pending = collections.deque()
+            held = 0  # Bytes of the files workers are reading or holding
+            files = iter(files)
+            while True:
+                while len(pending) < workers * 4 and (not pending or held < BULK_WINDOW_BYTES):
+                    item = next(files, None)
+                    if item is None:
+                        break
+                    file_path, name = item
+                    file_size = os.path.getsize(file_path)
+                    future = None
+                    # Too big for memory: the writer streams it when its turn comes
+                    if not self.dedup and file_size <= BULK_INMEMORY_LIMIT:
+                        future = pool.submit(prepare_member, file_path, name, compression)
+                        held += file_size
+                    pending.append((file_path, name, file_size, future))
+                if not pending:
+                    break
+                file_path, name, file_size, future = pending.popleft()
+                prepared = future.result() if future else None
+                if prepared:
+                    tx.write_prepared(*prepared)
+                else:
+                    tx.write_file(file_path, name, compression)
+                if future:
+                    held -= file_size
+                count += 1
+                size += file_size
+        return count, size
+
+    def remove(self, name):
+        with self.transaction() as tx:
+            return tx.remove(name)
+
+    def replace_file(self, old_name, file_path):
+        """Drop old_name and store file_path in its place (under the new file's name)."""
+        with self.transaction() as tx:
+            tx.remove(old_name)
+            tx.write_file(file_path)
+
+    def wipe(self):
+        """Delete every member, leaving an empty archive."""
+        with self._lock:
+            self._check_no_transaction("wipe")
+            self._replace_with_empty()
+        metrics.count('archive rewrites')
+        self._notify(None)
+
+    def _check_no_transaction(self, action):
+        # Both swap in a new file under the open transaction, whose commit would then undo it
+        if self._lock.transaction is not None:
+            raise RuntimeError(f"can't {action} memory.zip while a transaction is open")
+
+    def _replace_with_empty(self):
+        # Written aside and renamed in, so a crash leaves either the old archive or the empty one
+        tmp_path = self.path + '.wipe'
+        with zipfile.ZipFile(tmp_path, 'w') as zipf:
+            pass
+        _fsync(tmp_path)
+        with self._index_lock:
+            os.replace(tmp_path, self.path)
+            self._load(zipf)
+
+    def dead_bytes(self):
+        """Bytes before the central directory that no live member uses."""
+        self.refresh()
+        return self._start_dir - sum(member_span(info) for info in self._index.values())
+
+    def maybe_compact(self, dead, data):
+        """Start a background compaction if dead space is over the threshold."""
+        if dead < COMPACT_MIN_BYTES or dead < data * self.compact_threshold:
+            return
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        # Not a daemon: exiting waits for the rewrite instead of leaving a stray temp file
+        self._compactor = threading.Thread(target=self.compact, name="memory-compact")
+        self._compactor.start()
+
+    def compact(self):
+        """Rewrite memory.zip with only the live members and referenced blobs. Returns the number of bytes reclaimed.
+
+        Member data is copied raw, nothing is recompressed. The new archive is
+        written next to the old one and swapped in with a rename.
+        """
+        with self._lock:
+            self._check_no_transaction("compact")
+            tmp_path = self.path + '.compact'
+            before = os.path.getsize(self.path)
+            with zipfile.ZipFile(self.path, 'r') as old, open(self.path, 'rb') as src, \
+                    zipfile.ZipFile(tmp_path, 'w') as new:
+                # Blobs no pointer refers to any more are garbage collected here
+                referenced = set()
+                for info in old.infolist():
+                    if dedup.is_pointer(info):
+                        referenced.update(old.read(info).decode().split())
+                live = [info for info in old.infolist()
+                        if not info.filename.startswith(dedup.BLOB_PREFIX) or info.filename in referenced]
+                for info in sorted(live, key=lambda i: i.header_offset):
+                    length = _raw_member_length(src, info)
+                    offset = info.header_offset
+                    info.header_offset = new.fp.tell()
+                    _copy_range(src, new.fp, offset, length)
+                    new.filelist.append(info)
+                    new.NameToInfo[info.filename] = info
+                new.start_dir = new.fp.tell()
+            _fsync(tmp_path)
+            with self._index_lock:
+                os.replace(tmp_path, self.path)
+                self._load(new)
+            metrics.count('archive rewrites')
+            metrics.count('bytes written', self._stamp[1])
+            return before - self._stamp[1]
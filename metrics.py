@@ -0,0 +1,111 @@
+"""Counters and latency histograms collected while SussyOS runs.
+
+The hooks are cheap (a lock and an addition) and always on:
+
+    metrics.count('bytes read', len(chunk))
+    metrics.observe('filemanager add', seconds)
+    with metrics.timed('memory commit'):
+        ...
+
+report() formats everything for the 'stats' commands, snapshot() gives
+it as plain data.
+"""
+import bisect
+import collections
+import contextlib
+import threading
+import time
+
+# Upper bounds of the latency buckets in milliseconds; a last bucket takes the rest
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram:
+    """Latencies counted into the fixed BUCKETS_MS buckets, plus count, total and max."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """Upper bound (ms) of the bucket the given fraction of samples falls in."""
+        wanted = fraction * self.count
+        seen = 0
+        for bound, hits in zip(BUCKETS_MS, self.buckets):
+            seen += hits
+            if seen >= wanted:
+                return bound
+        return self.max * 1000
+
+    def as_dict(self):
+        labels = [f"<={bound}ms" for bound in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}ms"]
+        return {'count': self.count, 'total_ms': self.total * 1000, 'max_ms': self.max * 1000,
+                'buckets': {label: hits for label, hits in zip(labels, self.buckets) if hits}}
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.counters = collections.Counter()
+        self.latencies = collections.defaultdict(Histogram)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self.latencies[name].add(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return {'uptime': time.time() - self.started,
+                    'counters': dict(self.counters),
+                    'latencies': {name: histogram.as_dict() for name, histogram in self.latencies.items()}}
+
+    def report(self):
+        """Lines of text describing everything collected so far."""
+        with self._lock:
+            lines = [f"Up {time.time() - self.started:.0f}s"]
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"  {name:<28} {value:>14,}")
+            if self.latencies:
+                lines.append(f"  {'LATENCY':<28} {'COUNT':>7} {'MEAN ms':>9} {'P50':>6} {'P90':>6} {'P99':>6} {'MAX ms':>9}")
+            for name, h in sorted(self.latencies.items()):
+                lines.append(f"  {name:<28} {h.count:>7} {h.total / h.count * 1000:>9.2f} "
+                             f"{h.percentile(.5):>6g} {h.percentile(.9):>6g} {h.percentile(.99):>6g} "
+                             f"{h.max * 1000:>9.2f}")
+                lines.append("      " + "  ".join(f"{label} {hits}" for label, hits in h.as_dict()['buckets'].items()))
+            return lines
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.counters.clear()
+            self.latencies.clear()
+
+
+# One set of metrics for the whole process
+METRICS = Metrics()
+count = METRICS.count
+observe = METRICS.observe
+timed = METRICS.timed
+snapshot = METRICS.snapshot
+report = METRICS.report
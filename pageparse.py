@@ -0,0 +1,145 @@
+import html.parser
+
+try:
+    from lxml import etree
+except ImportError:  # lxml is optional, the stdlib tokenizer does the same job slower
+    etree = None
+
+BACKENDS = ('lxml', 'html.parser') if etree is not None else ('html.parser',)
+BACKEND = BACKENDS[0]
+# lxml complains when closing an empty or cut off document
+_CLOSE_ERRORS = (etree.XMLSyntaxError,) if etree is not None else ()
+
+# Pages are fed to the parser in pieces this big, so it can stop early
+FEED_SIZE = 64 * 1024
+
+# DuckDuckGo puts its results in this element; parsing ends when it closes
+RESULTS_CONTAINER = 'links'
+# Image srcs collected from one page; parsing ends once there are this many
+MAX_IMAGES = 200
+
+
+class _Collector:
+    """Parser target that keeps only the few elements the browser shows.
+
+    Works as an lxml parser target and behind _Tokenizer, so both backends
+    see the same start/end/data calls and nothing else is built. Sets done
+    once there is nothing left worth reading.
+    """
+
+    def __init__(self, results=False, images=True):
+        self.results = results
+        self.images = images
+        self.links = []
+        self.title = None
+        self.description = None
+        self.first_text = None
+        self.srcs = []
+        self.done = False
+        self._text = None  # Text pieces while inside an <a> result or <title>
+        self._href = None
+        self._skip = 0  # Depth in <script>/<style>
+        self._container = 0  # Depth in the results container, once found
+
+    def start(self, tag, attrs):
+        if self._container:
+            self._container += tag == 'div'
+        if tag in ('script', 'style'):
+            self._skip += 1
+        elif self.results:
+            if tag == 'a' and 'result__a' in (attrs.get('class') or '').split():
+                self._text, self._href = [], attrs.get('href', '')
+            elif tag == 'div' and attrs.get('id') == RESULTS_CONTAINER and not self._container:
+                self._container = 1
+        elif tag == 'title' and self.title is None:
+            self._text = []
+        elif tag == 'meta' and attrs.get('name') == 'description' and self.description is None:
+            self.description = attrs.get('content')
+        elif tag == 'img' and attrs.get('src') and len(self.srcs) < MAX_IMAGES:
+            self.srcs.append(attrs['src'])
+            if len(self.srcs) >= MAX_IMAGES and (self.title is not None or self.first_text is not None):
+                self.done = True
+        elif tag == 'body' and not self.images:
+            self.done = True
+
+    def end(self, tag):
+        if tag in ('script', 'style'):
+            self._skip = max(self._skip - 1, 0)
+        elif tag == 'a' and self._href is not None:
+            self.links.append((''.join(self._text), self._href))
+            self._text = self._href = None
+        elif tag == 'title' and self._text is not None and self._href is None:
+            self.title = ''.join(self._text)
+            self._text = None
+        elif tag == 'head' and not self.results and not self.images:
+            self.done = True
+        elif tag == 'body' and not self.results:
+            self.done = True
+        if self._container and tag == 'div':
+            self._container -= 1
+            self.done = not self._container
+
+    def data(self, text):
+        if self._text is not None:
+            self._text.append(text)
+        elif not self._skip and self.first_text is None and not self.results and text.strip():
+            self.first_text = text.strip().split('\n')[0]
+
+    def close(self):
+        return self
+
+
+class _Tokenizer(html.parser.HTMLParser):
+    """Stdlib fallback: feeds a _Collector from the streaming HTMLParser tokenizer."""
+
+    def __init__(self, target):
+        super().__init__()
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag, dict(attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        self.target.start(tag, dict(attrs))
+        self.target.end(tag)
+
+    def handle_endtag(self, tag):
+        self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+
+def _parse(text, collector, backend=None):
+    backend = backend or BACKEND
+    if backend == 'lxml':
+        parser = etree.HTMLParser(target=collector)
+    else:
+        parser = _Tokenizer(collector)
+    for start in range(0, len(text), FEED_SIZE):
+        parser.feed(text[start:start + FEED_SIZE])
+        if collector.done:
+            break
+    try:
+        parser.close()
+    except _CLOSE_ERRORS:
+        pass  # Whatever was collected stands
+    return collector
+
+
+def parse_results(text, backend=None):
+    """(title, href) of every search result link on a DuckDuckGo HTML page."""
+    return _parse(text, _Collector(results=True), backend).links
+
+
+def parse_details(text, images=True, backend=None):
+    """(title, description, image srcs) of a page.
+
+    title falls back to the first line of text when there is no <title>,
+    description is None without a meta description. Parsing stops at the
+    end of <body>, or once MAX_IMAGES srcs are in; with images=False it
+    stops at the end of <head>.
+    """
+    collector = _parse(text, _Collector(images=images), backend)
+    title = collector.title if collector.title is not None else collector.first_text
+    return title, collector.description, collector.srcs
@@ -1,22 +1,17 @@
-import zipfile
-import os
-from lupa import LuaRuntime
+import fnmatch
+import history
+import luaengine
+import metrics
+import searchindex
+import time
+from commands import CommandError, command, help_command, parse_args, run_from_menu, stats_command
+from luaengine import ENGINE, LuaError, ScriptAborted, lua_error_text
+from memorystore import MemoryStore
 
-# Memory storage file (the zip file)
-MEMORY_FILE = "memory.zip"
+def list_files(memory):
+    return memory.names()
 
-def create_or_open_memory():
-    # Create or open the memory.zip file
-    if not os.path.exists(MEMORY_FILE):
-        with zipfile.ZipFile(MEMORY_FILE, 'w') as zf:
-            pass  # Create an empty zip file
-    return zipfile.ZipFile(MEMORY_FILE, 'a')
-
-def list_files():
-    with create_or_open_memory() as memory:
-        return memory.namelist()
-
-def write_program(filename):
+def write_program(memory, filename):
     program_content = []
     print(f"Entering program mode. Write your code. Type 'OS_EXIT' to finish.")
     while True:
@@ -26,64 +21,252 @@ def write_program(filename):
         else:
             program_content.append(line)  # Add the line to the program content
     full_content = "\n".join(program_content)  # Join all lines with newline characters
-    with create_or_open_memory() as memory:
-        memory.writestr(filename, full_content)
+    history.save(memory, filename, full_content, "write")
+    ENGINE.invalidate(filename)
     print(f"Program '{filename}' written successfully.")
 
-def modify_program(filename):
-    with create_or_open_memory() as memory:
-        if filename not in memory.namelist():
-            print(f"Program '{filename}' not found.")
-            return
-        existing_content = memory.read(filename).decode()
-        program_content = existing_content.splitlines()
-        print(f"Modifying '{filename}'. Existing content loaded. Type 'OS_EXIT' to finish.")
-        while True:
-            for idx, line in enumerate(program_content):
-                print(f"{idx + 1}: {line}")
-            line_number = input(f"Enter line number to edit or type 'add' to add a new line (or 'OS_EXIT' to finish): ").strip()
-            if line_number.lower() == "os_exit":
-                break
-            elif line_number.lower() == "add":
-                new_line = input(f"New line: ").strip()
-                program_content.append(new_line)
-            elif line_number.isdigit() and 1 <= int(line_number) <= len(program_content):
-                new_line = input(f"New content for line {line_number}: ").strip()
-                program_content[int(line_number) - 1] = new_line
-            else:
-                print("Invalid input. Please try again.")
-        full_content = "\n".join(program_content)  # Join the modified content
-        memory.writestr(filename, full_content)
-        print(f"Program '{filename}' modified successfully.")
-
-def remove_program(filename):
-    with create_or_open_memory() as memory:
-        if filename in memory.namelist():
-            temp = memory.namelist()
-            temp.remove(filename)
-            with zipfile.ZipFile(MEMORY_FILE, 'w') as new_memory:
-                for file in temp:
-                    new_memory.writestr(file, memory.read(file))
-            print(f"Program '{filename}' removed.")
+def modify_program(memory, filename):
+    if filename not in memory:
+        print(f"Program '{filename}' not found.")
+        return
+    existing_content = memory.read(filename).decode()
+    program_content = existing_content.splitlines()
+    print(f"Modifying '{filename}'. Existing content loaded. Type 'OS_EXIT' to finish.")
+    while True:
+        for idx, line in enumerate(program_content):
+            print(f"{idx + 1}: {line}")
+        line_number = input(f"Enter line number to edit or type 'add' to add a new line (or 'OS_EXIT' to finish): ").strip()
+        if line_number.lower() == "os_exit":
+            break
+        elif line_number.lower() == "add":
+            new_line = input(f"New line: ").strip()
+            program_content.append(new_line)
+        elif line_number.isdigit() and 1 <= int(line_number) <= len(program_content):
+            new_line = input(f"New content for line {line_number}: ").strip()
+            program_content[int(line_number) - 1] = new_line
         else:
-            print("File not found.")
+            print("Invalid input. Please try again.")
+    full_content = "\n".join(program_content)  # Join the modified content
+    history.save(memory, filename, full_content, "modify")
+    ENGINE.invalidate(filename)
+    print(f"Program '{filename}' modified successfully.")
 
-def run_lua_program(filename):
-    with create_or_open_memory() as memory:
-        if filename in memory.namelist():
-            lua_code = memory.read(filename).decode()
-            lua = LuaRuntime(unpack_returned_tuples=True)  # Lua runtime
-            try:
-                # Run the Lua script
-                result = lua.execute(lua_code)
-                print(f"Lua Script Output: {result}")
-            except Exception as e:
-                print(f"Error running Lua script: {e}")
+def remove_program(memory, filename):
+    if memory.remove(filename):
+        ENGINE.invalidate(filename)
+        print(f"Program '{filename}' removed.")
+    else:
+        print("File not found.")
+
+def run_lua_program(memory, filename):
+    if filename in memory:
+        lua_code = memory.read(filename)
+        start = time.perf_counter()
+        try:
+            # Run the Lua script on a warm runtime, reusing its compiled chunk
+            result = ENGINE.run(filename, lua_code, memory)
+            print(f"Lua Script Output: {result}")
+        except ScriptAborted as e:
+            print(f"Lua script aborted after {time.perf_counter() - start:.2f}s: {e}")
+        except LuaError as e:
+            print(f"Error running Lua script: {lua_error_text(e)}")
+        except Exception as e:
+            print(f"Error running Lua script: {e}")
+    else:
+        print("File not found.")
+
+def profile_lua_program(memory, filename, top=15):
+    """Run a script under the profiler and print its hottest lines and functions."""
+    if filename not in memory:
+        print("File not found.")
+        return
+    start = time.perf_counter()
+    try:
+        result, lines, funcs = ENGINE.profile(filename, memory.read(filename), memory)
+    except ScriptAborted as e:
+        print(f"Lua script aborted after {time.perf_counter() - start:.2f}s: {e}")
+        return
+    except LuaError as e:
+        print(f"Error running Lua script: {lua_error_text(e)}")
+        return
+    print(f"Lua Script Output: {result}")
+    for title, rows in (("LINES", lines), ("FUNCTIONS", funcs)):
+        total = sum(seconds for _, _, seconds in rows) or 1
+        print(f"\n{title} (self time)")
+        print(f"{'HITS':>10}  {'ms':>10}  {'%':>5}  WHERE")
+        for where, hits, seconds in rows[:top]:
+            print(f"{hits:>10}  {seconds * 1000:>10.2f}  {seconds / total * 100:>5.1f}  {where}")
+
+def set_limits(args):
+    """'limits' shows the Lua limits, 'limits INSTRUCTIONS MEMORY_MB' changes them (0 = no limit)."""
+    if args:
+        instructions, megabytes = (int(value) for value in args.split())
+        ENGINE.set_limits(instructions or None, megabytes * 1024 * 1024 or None)
+    memory_limit = f"{ENGINE.max_memory // 1024 // 1024} MB" if ENGINE.max_memory else "none"
+    print(f"Instruction limit: {ENGINE.max_instructions or 'none'}, memory limit: {memory_limit}")
+
+def run_all_programs(memory, pattern, timeout=luaengine.BATCH_TIMEOUT):
+    """Run every script matching pattern in parallel and print a summary table."""
+    scripts = [(name, memory.read(name)) for name in memory.names() if fnmatch.fnmatch(name, pattern)]
+    if not scripts:
+        print("No programs match.")
+        return []
+    results = luaengine.run_batch(scripts, timeout=timeout, memory_path=memory.path)
+    for result in results:
+        if result.output:
+            print(f"--- {result.name} output ---")
+            print(result.output, end='' if result.output.endswith('\n') else '\n')
+    width = max(len(result.name) for result in results)
+    print(f"{'NAME':<{width}}  STATUS  WALL ms   CPU ms  RESULT")
+    for result in results:
+        cpu = f"{result.cpu * 1000:8.1f}" if result.cpu is not None else "       -"
+        print(f"{result.name:<{width}}  {'ok' if result.ok else 'FAIL':<6}  {result.wall * 1000:7.1f}  {cpu}  "
+              f"{result.result if result.ok else result.error.splitlines()[0]}")
+    failed = sum(not result.ok for result in results)
+    print(f"{len(results)} programs run, {failed} failed.")
+    return results
+
+# Non-interactive commands, for sussy.run("programmer ...") and batch files
+
+help_command("programmer")
+stats_command("programmer")
+
+def _script(memory, filename):
+    if filename not in memory:
+        raise CommandError(f"Program {filename} not found")
+    return memory.read(filename)
+
+def _content(text):
+    """'--file PATH' reads the content from a file on disk, anything else is the content itself."""
+    if text.startswith('--file '):
+        path = text[len('--file '):].strip()
+        try:
+            with open(path, encoding='utf-8') as f:
+                return f.read()
+        except OSError as e:
+            raise CommandError(f"Can't read {path}: {e.strerror}")
+    return text
+
+def _save(memory, filename, content, note):
+    if not filename:
+        raise CommandError("No program name given")
+    rev = history.save(memory, filename, content, note)
+    ENGINE.invalidate(filename)
+    return {'name': filename, 'size': len(content.encode('utf-8')), 'rev': rev}
+
+@command("programmer", "write", "NAME CONTENT | NAME --file PATH")
+def write_command(memory, args):
+    filename, _, content = args.partition(' ')
+    result = _save(memory, filename, _content(content), "write")
+    print(f"Program '{filename}' written successfully.")
+    return result
+
+@command("programmer", "modify", "NAME LINE|add CONTENT | NAME --file PATH")
+def modify_command(memory, args):
+    filename, _, rest = args.partition(' ')
+    lines = _script(memory, filename).decode('utf-8').splitlines()
+    if rest.startswith('--file '):
+        content = _content(rest)
+    else:
+        where, _, new_line = rest.partition(' ')
+        if where.lower() == 'add':
+            lines.append(new_line)
+        elif where.isdigit() and 1 <= int(where) <= len(lines):
+            lines[int(where) - 1] = new_line
         else:
-            print("File not found.")
+            raise CommandError(f"{filename} has no line {where}")
+        content = "\n".join(lines)
+    result = _save(memory, filename, content, "modify")
+    print(f"Program '{filename}' modified successfully.")
+    return result
+
+@command("programmer", "list")
+def list_command(memory, args):
+    names = list_files(memory)
+    for name in names:
+        print(name)
+    return names
+
+@command("programmer", "run", "NAME")
+def run_command(memory, args):
+    output = []
+    try:
+        result = ENGINE.run(args, _script(memory, args), memory, output)
+    except ScriptAborted as e:
+        raise CommandError(f"Lua script aborted: {e}")
+    except LuaError as e:
+        raise CommandError(f"Error running Lua script: {lua_error_text(e)}")
+    finally:
+        print(''.join(output), end='')
+    return result
+
+@command("programmer", "runall", "PATTERN [TIMEOUT]")
+def runall_command(memory, args):
+    pattern, _, timeout = args.partition(' ')
+    results = run_all_programs(memory, pattern, float(timeout) if timeout else luaengine.BATCH_TIMEOUT)
+    return [result._asdict() for result in results]
+
+@command("programmer", "profile", "NAME")
+def profile_command(memory, args):
+    output = []
+    try:
+        result, lines, funcs = ENGINE.profile(args, _script(memory, args), memory, output)
+    except ScriptAborted as e:
+        raise CommandError(f"Lua script aborted: {e}")
+    except LuaError as e:
+        raise CommandError(f"Error running Lua script: {lua_error_text(e)}")
+    finally:
+        print(''.join(output), end='')
+    for where, hits, seconds in lines[:15]:
+        print(f"{hits:>10}  {seconds * 1000:>10.2f} ms  {where}")
+    return {'result': result, 'lines': lines, 'functions': funcs}
+
+@command("programmer", "limits", "[INSTRUCTIONS MEMORY_MB]")
+def limits_command(memory, args):
+    set_limits(args)
+    return {'instructions': ENGINE.max_instructions, 'memory': ENGINE.max_memory}
+
+@command("programmer", "find", 'WORD... | "PHRASE"')
+def find_command(memory, args):
+    hits = searchindex.find(memory, args)
+    return [{'name': name, 'line': number, 'text': text} for name, number, text in hits]
+
+@command("programmer", "history", "NAME")
+def history_command(memory, args):
+    return history.show_history(memory, args)
 
-def main():
+@command("programmer", "diff", "NAME REV1 REV2")
+def diff_command(memory, args):
+    filename, old, new = parse_args(args, "programmer diff NAME REV1 REV2",
+                                    str, history.parse_rev, history.parse_rev)
+    try:
+        return history.show_diff(memory, filename, old, new)
+    except KeyError as e:
+        raise CommandError(e.args[0])
+
+@command("programmer", "revert", "NAME REV")
+def revert_command(memory, args):
+    filename, rev = parse_args(args, "programmer revert NAME REV", str, history.parse_rev)
+    try:
+        result = history.revert(memory, filename, rev)
+    except KeyError as e:
+        raise CommandError(e.args[0])
+    ENGINE.invalidate(filename)
+    return result
+
+@command("programmer", "remove", "NAME")
+def remove_command(memory, args):
+    if not memory.remove(args):
+        raise CommandError(f"Program {args} not found")
+    ENGINE.invalidate(args)
+    print(f"Program '{args}' removed.")
+    return True
+
+def main(memory=None):
     print("PROGRAMMER")
+    if memory is None:
+        memory = MemoryStore()
+    ENGINE.warm()
     print("\n")
     while True:
         command = input("Enter command: ").strip().lower()
@@ -98,24 +281,67 @@ def main():
             print("modify NAME - modifies a lua script with NAME")
             print("remove NAME - removes lua script with NAME")
             print("run NAME - runs lua script with NAME")
-            print("list - printing every file (definately not useless)")
+            print("runall PATTERN [TIMEOUT] - runs every matching script in parallel (e.g. runall *.lua)")
+            print("profile NAME - runs lua script with NAME and shows where it spends its time")
+            print("limits [INSTRUCTIONS MEMORY_MB] - shows or sets the limits scripts are aborted at")
+            print("list - printing every file with its size (definately not useless)")
+            print('find WORD... / find "PHRASE" - shows the files and lines that contain it')
+            print("history NAME - lists the saved revisions of a script")
+            print("diff NAME R1 R2 - shows what changed between two revisions (e.g. diff a.lua r1 r3)")
+            print("revert NAME RN - brings revision RN back as the newest one")
             print("exit - exit the programmer")
             print("---------------------------------------------")
             print("\n")
+            print("Scripts reach files in memory with memory.lines(name), memory.read(name, offset, len),")
+            print("memory.chunks(name), memory.open(name), memory.write(name, data) and memory.list()")
             print("REMEMBER: ONLY SMALL LETTERS IN COMMANDS! (NOT WHEN PROGRAMMING)")
         elif command == "list":
-            print(list_files())
+            with metrics.timed("programmer list"):
+                for name, size, packed, codec in memory.listing():
+                    print(f"{name} - {size} bytes ({packed} in memory, {codec})")
         elif command.startswith("write "):
             _, filename = command.split(" ", 1)
-            write_program(filename)
+            write_program(memory, filename)
         elif command.startswith("modify "):
             _, filename = command.split(" ", 1)
-            modify_program(filename)
+            modify_program(memory, filename)
         elif command.startswith("remove "):
             _, filename = command.split(" ", 1)
-            remove_program(filename)
+            with metrics.timed("programmer remove"):
+                remove_program(memory, filename)
+        elif command.startswith("profile "):
+            _, filename = command.split(" ", 1)
+            with metrics.timed("programmer profile"):
+                profile_lua_program(memory, filename)
+        elif command == "limits" or command.startswith("limits "):
+            try:
+                set_limits(command[len("limits"):].strip())
+            except ValueError:
+                print("Usage: limits INSTRUCTIONS MEMORY_MB")
+        elif command.startswith("history "):
+            _, filename = command.split(" ", 1)
+            with metrics.timed("programmer history"):
+                history.show_history(memory, filename)
+        elif command.startswith("diff ") or command.startswith("revert "):
+            command, _, args = command.partition(" ")
+            run_from_menu("programmer", command, memory, args)
+        elif command.startswith("find "):
+            _, query = command.split(" ", 1)
+            with metrics.timed("programmer find"):
+                searchindex.find(memory, query)
+        elif command.startswith("runall "):
+            _, pattern = command.split(" ", 1)
+            pattern, _, timeout = pattern.partition(" ")
+            try:
+                timeout = float(timeout) if timeout else luaengine.BATCH_TIMEOUT
+            except ValueError:
+                print("Invalid timeout!")
+                continue
+            with metrics.timed("programmer runall"):
+                run_all_programs(memory, pattern, timeout)
         elif command.startswith("run "):
             _, filename = command.split(" ", 1)
-            run_lua_program(filename)
+            with metrics.timed("programmer run"):
+                run_lua_program(memory, filename)
         else:
             print("Unknown command! use 'help' for list of commands")
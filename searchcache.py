@@ -0,0 +1,78 @@
+import collections
+import json
+import os
+import threading
+import time
+from httpcache import CACHE_DIR
+
+SEARCH_CACHE_FILE = os.path.join(CACHE_DIR, "searches.json")
+# Queries remembered, least recently used dropped first...
+MAX_QUERIES = 200
+# ...and how long their results are trusted, in seconds
+SEARCH_TTL = 60 * 60
+
+
+def normalize(query):
+    """Cache key of a query: case and spacing don't make a different search."""
+    return ' '.join(query.lower().split())
+
+
+class SearchCache:
+    """Search results by normalized query, LRU with a TTL, kept in a JSON file across sessions."""
+
+    def __init__(self, path=SEARCH_CACHE_FILE, max_queries=MAX_QUERIES, ttl=SEARCH_TTL):
+        self.path = path
+        self.max_queries = max_queries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = None  # key -> (saved at, results), loaded on first use
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    self._entries = collections.OrderedDict(
+                        (key, (saved, [tuple(result) for result in results]))
+                        for key, saved, results in json.load(f))
+            except (OSError, ValueError):
+                self._entries = collections.OrderedDict()
+        return self._entries
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump([(key, saved, results) for key, (saved, results) in self._entries.items()], f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def get(self, query):
+        """Cached results for query, None if unknown or older than the TTL."""
+        key = normalize(query)
+        with self._lock:
+            entry = self._load().get(key)
+            if entry is None:
+                return None
+            saved, results = entry
+            if time.time() - saved > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return results
+
+    def put(self, query, results):
+        with self._lock:
+            entries = self._load()
+            key = normalize(query)
+            entries.pop(key, None)
+            entries[key] = (time.time(), list(results))
+            while len(entries) > self.max_queries:
+                entries.popitem(last=False)
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self._load().clear()
+            self._save()
+
+
+# Shared by the browser for the whole session
+SEARCH_CACHE = SearchCache()
@@ -0,0 +1,196 @@
+import codecs
+import json
+import re
+import sqlite3
+import threading
+import weakref
+import dedup
+
+# The index lives next to the archive: memory.zip.index
+INDEX_SUFFIX = ".index"
+# Members bigger than this, or that don't look like UTF-8 text, are not indexed
+MAX_INDEXED_SIZE = 16 * 1024 * 1024
+TEXT_SAMPLE = 8192
+# Matches returned by find() unless asked for more
+FIND_LIMIT = 100
+# sync() goes over the archive again if it changed while indexing, at most
+# this many times in a row; what is left is caught by the next sync()
+SYNC_PASSES = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS members(id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, stamp TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS lines(id INTEGER PRIMARY KEY, member INTEGER NOT NULL, line INTEGER NOT NULL,
+                                 text TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS lines_member ON lines(member);
+CREATE VIRTUAL TABLE IF NOT EXISTS lines_fts USING fts5(text, content='lines', content_rowid='id');
+"""
+
+_TERMS = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def _member_stamp(info):
+    """Changes whenever the member's content does (for dedup the comment carries size and digest)."""
+    return f"{info.CRC:08x} {info.file_size} {info.comment.decode('ascii', 'replace')}"
+
+
+def match_expression(query):
+    """FTS5 query for what the user typed: words and "quoted phrases", all on the same line."""
+    terms = [(phrase or word).replace('"', '""') for phrase, word in _TERMS.findall(query)]
+    return ' '.join(f'"{term}"' for term in terms if term.strip())
+
+
+class SearchIndex:
+    """Full-text index of memory's text members, by line, in SQLite (FTS5).
+
+    Kept up to date incrementally: as a listener of the MemoryStore it
+    re-reads only the members a commit wrote or removed. Changes it didn't
+    see (other processes, or before it was opened) are caught by comparing
+    the archive's stamp, and then each member's CRC and size, with what was
+    indexed; only members that differ are read again.
+    """
+
+    def __init__(self, memory, path=None):
+        self.memory = memory
+        self.path = path or memory.path + INDEX_SUFFIX
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.executescript(_SCHEMA)
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'stamp'").fetchone()
+        self._synced = tuple(json.loads(row[0])) if row else None
+
+    def _text_lines(self, name):
+        """Lines of name if it is text worth indexing, else None."""
+        if self.memory.size(name) > MAX_INDEXED_SIZE:
+            return None
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for chunk in self.memory.iter_chunks(name, end=TEXT_SAMPLE):
+            chunk = bytes(chunk)
+            if b'\0' in chunk:
+                return None
+            try:
+                decoder.decode(chunk)
+            except UnicodeDecodeError:
+                return None
+        try:
+            return [line.rstrip('\r\n') for line in self.memory.iter_lines(name)]
+        except UnicodeDecodeError:
+            return None
+
+    def _drop(self, member):
+        self._db.execute("INSERT INTO lines_fts(lines_fts, rowid, text) "
+                         "SELECT 'delete', id, text FROM lines WHERE member = ?", (member,))
+        self._db.execute("DELETE FROM lines WHERE member = ?", (member,))
+
+    def _update(self, names):
+        """Re-index names from the archive (dropping the ones that are gone); caller holds the lock."""
+        for name in names:
+            if name.startswith(dedup.RESERVED_PREFIX):
+                continue
+            row = self._db.execute("SELECT id, stamp FROM members WHERE name = ?", (name,)).fetchone()
+            try:
+                stamp = _member_stamp(self.memory.getinfo(name))
+            except KeyError:
+                stamp = None
+            if row and row[1] == stamp:
+                continue
+            if row:
+                self._drop(row[0])
+                self._db.execute("DELETE FROM members WHERE id = ?", (row[0],))
+            if stamp is None:
+                continue
+            member = self._db.execute("INSERT INTO members(name, stamp) VALUES (?, ?)", (name, stamp)).lastrowid
+            lines = self._text_lines(name) or ()
+            self._db.executemany("INSERT INTO lines(member, line, text) VALUES (?, ?, ?)",
+                                 ((member, number, text) for number, text in enumerate(lines, 1) if text.strip()))
+            self._db.execute("INSERT INTO lines_fts(rowid, text) SELECT id, text FROM lines WHERE member = ?",
+                             (member,))
+
+    def _mark_synced(self, stamp):
+        """Record that the index matches the archive as it was at stamp."""
+        self._synced = stamp
+        self._db.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('stamp', ?)",
+                         (json.dumps(self._synced),))
+
+    def sync(self):
+        """Catch up with changes the listener didn't see. Returns the number of members re-indexed."""
+        with self._lock:
+            count = 0
+            for _ in range(SYNC_PASSES):
+                # Read before indexing: a commit made while indexing leaves the
+                # stamp different from this one, so it gets its own pass
+                synced = self.memory.stamp()
+                if synced == self._synced:
+                    break
+                current = {name: _member_stamp(self.memory.getinfo(name)) for name in self.memory.names()}
+                stored = dict(self._db.execute("SELECT name, stamp FROM members"))
+                changed = [name for name, stamp in current.items() if stored.get(name) != stamp]
+                changed += [name for name in stored if name not in current]
+                with self._db:
+                    self._update(changed)
+                    self._mark_synced(synced)
+                count += len(changed)
+            return count
+
+    def changed(self, names, stamps):
+        """MemoryStore listener: re-index what a commit touched.
+
+        Only when the index was in sync with the archive just before the
+        commit is it in sync after it; otherwise sync() still has other
+        changes to find.
+        """
+        if names is None or self._synced is None:
+            # A wipe, or never synced: let sync() compare everything
+            self._synced = None
+            return
+        before, after = stamps
+        with self._lock, self._db:
+            self._update(names)
+            if before == self._synced:
+                self._mark_synced(after)
+
+    def find(self, query, limit=FIND_LIMIT):
+        """(name, line number, line) of lines with every word and "phrase" in query, by name and line."""
+        expression = match_expression(query)
+        if not expression:
+            return []
+        self.sync()
+        with self._lock:
+            return self._db.execute(
+                "SELECT members.name, lines.line, lines.text FROM lines_fts "
+                "JOIN lines ON lines.id = lines_fts.rowid JOIN members ON members.id = lines.member "
+                "WHERE lines_fts MATCH ? ORDER BY members.name, lines.line LIMIT ?",
+                (expression, limit)).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# One index per MemoryStore, opened on first use and then kept current by its listener
+_indexes = weakref.WeakKeyDictionary()
+_indexes_guard = threading.Lock()
+
+
+def index_for(memory):
+    """The SearchIndex of memory, opening it (and hooking it to memory's commits) the first time."""
+    with _indexes_guard:
+        index = _indexes.get(memory)
+        if index is None:
+            index = _indexes[memory] = SearchIndex(memory)
+            memory.listeners.append(index.changed)
+        return index
+
+
+def find(memory, query, limit=FIND_LIMIT):
+    """Print and return the (name, line number, line) matches of query in memory."""
+    hits = index_for(memory).find(query, limit)
+    if not hits:
+        print("Nothing found.")
+    for name, number, text in hits:
+        text = text.strip()
+        print(f"{name}:{number}: {text[:120] + '...' if len(text) > 120 else text}")
+    if len(hits) == limit:
+        print(f"(first {limit} matches)")
+    return hits
@@ -0,0 +1,73 @@
+"""Run SussyOS commands without prompts, from Python or as a batch.
+
+From Python:
+
+    import sussy
+    result = sussy.run("filemanager add notes.txt")
+    result.ok, result.value, result.output
+
+From the shell, one command per line from a file (or stdin):
+
+    python sussy.py commands.txt [--json] [--stop-on-error] [--stats]
+
+Commands are 'APP COMMAND ARGS', e.g. 'programmer run hello.lua';
+'APP help' lists an app's commands. --stats prints the latency
+histograms and counters of the batch at the end.
+"""
+import json
+import sys
+import time
+import metrics
+from commands import Dispatcher
+
+_dispatcher = None
+
+
+def dispatcher():
+    """The Dispatcher shared by run() and run_many(), on memory.zip in the current directory."""
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = Dispatcher()
+    return _dispatcher
+
+
+def run(line):
+    """Run one command line and return its CommandResult."""
+    return dispatcher().run(line)
+
+
+def run_many(lines):
+    """Run every command in lines (blank lines and # comments are skipped). Returns a list of results."""
+    return list(dispatcher().run_many(lines))
+
+
+def main(argv):
+    as_json = '--json' in argv
+    stop_on_error = '--stop-on-error' in argv
+    paths = [arg for arg in argv if not arg.startswith('--')]
+    source = open(paths[0], encoding='utf-8') if paths else sys.stdin
+    start = time.perf_counter()
+    count = failed = 0
+    with source:
+        for result in dispatcher().run_many(source):
+            count += 1
+            failed += not result.ok
+            if as_json:
+                print(json.dumps(result._asdict(), default=str))
+            else:
+                print(result.output, end='')
+                if not result.ok:
+                    print(f"error: {result.command}: {result.error}", file=sys.stderr)
+            if stop_on_error and not result.ok:
+                break
+    seconds = max(time.perf_counter() - start, 1e-9)
+    print(f"{count} commands, {failed} failed, in {seconds:.2f}s ({count / seconds:.0f} commands/s)",
+          file=sys.stderr)
+    if '--stats' in argv:
+        for line in metrics.report():
+            print(line, file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))